@@ -0,0 +1,43 @@
+import contextlib
+import os
+import shutil
+import tempfile
+
+import instrumentation
+
+# Read the process umask once so new files get the usual permissions
+# instead of the 0600 that mkstemp() creates them with.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextlib.contextmanager
+def atomic_write(path, fsync=False):
+    """Write to a temporary file next to path and move it over path on success
+
+    The destination is only replaced once the block finishes without an
+    exception, so an interrupted write never leaves a half-written image.
+    The temporary file lives in the same directory so os.replace() stays a
+    rename on the same filesystem.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            if fsync:
+                f.flush()
+                with instrumentation.stage('fsync'):
+                    os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,163 @@
+"""Process pool helpers for the bulk metadata operations.
+
+Nothing in here imports tkinter, so the batch tools run on machines
+without a display. The same holds for every module except the viewer
+(metadata_manager_new.py) and its list widget (virtual_list.py), which
+is what lets the CLI, the benchmarks and the pool workers import them.
+"""
+import collections
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif')
+DEFAULT_CHUNKSIZE = 64
+# Files written between two filesystem syncs with batched fsync
+SYNC_BATCH_SIZE = 1000
+
+
+def is_image_path(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def walk_images(directory):
+    """Yield the image files below directory, using os.scandir()"""
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = sorted(os.scandir(current), key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Warning: Could not read {current}: {e}", file=sys.stderr)
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file() and is_image_path(entry.name):
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+def _glob_base(pattern):
+    """Return the leading directories of pattern that hold no wildcards"""
+    base = os.path.dirname(pattern)
+    while glob.has_magic(base):
+        base = os.path.dirname(base)
+    return base or os.curdir
+
+
+def iter_image_paths(patterns):
+    """Expand files, directories and glob patterns into image paths
+
+    Yields (path, relative_path) pairs. Directories are walked recursively
+    and relative_path keeps the layout below the directory that was given,
+    or below the part of a glob pattern before its first wildcard, so
+    results can be mirrored into an output folder.
+    """
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            sources = [(path, os.path.relpath(path, pattern)) for path in walk_images(pattern)]
+        elif glob.has_magic(pattern):
+            base = _glob_base(pattern)
+            sources = []
+            for match in sorted(glob.iglob(pattern, recursive=True)):
+                if os.path.isdir(match):
+                    sources.extend((path, os.path.relpath(path, base)) for path in walk_images(match))
+                elif is_image_path(match):
+                    sources.append((match, os.path.relpath(match, base)))
+        else:
+            sources = [(pattern, os.path.basename(pattern))]
+        for path, relative in sources:
+            key = os.path.abspath(path)
+            if key not in seen:
+                seen.add(key)
+                yield path, relative
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _run_chunk(func, chunk):
+    results = []
+    for args in chunk:
+        try:
+            results.append((args, func(*args), None))
+        except Exception as e:
+            results.append((args, None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def imap_chunked(func, items, workers=None, chunksize=DEFAULT_CHUNKSIZE, max_pending=None, mp_context=None):
+    """Run func over items in a process pool and yield the results in order
+
+    items is an iterable of argument tuples; func must be a module level
+    function (or functools.partial of one) so it can be pickled. Yields
+    (args, result, error) where error is a message string when func raised.
+    Items are submitted chunksize at a time and at most max_pending chunks
+    are in flight, so memory stays bounded however many items there are.
+    workers=1 runs everything in this process. mp_context picks the start
+    method of the workers; multithreaded callers such as the GUI must pass a
+    spawn context, a forked child could inherit a lock another thread held.
+    """
+    if workers == 1:
+        for chunk in _chunks(items, chunksize):
+            yield from _run_chunk(func, chunk)
+        return
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                             initializer=instrumentation.configure_worker) as pool:
+        pending = collections.deque()
+        for chunk in _chunks(items, chunksize):
+            pending.append(pool.submit(_run_chunk, func, chunk))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def sync_filesystems():
+    """Flush all written file data to disk, return False where unsupported
+
+    One call after a batch of writes replaces an fsync() per file.
+    """
+    if not hasattr(os, 'sync'):
+        return False
+    os.sync()
+    return True
+
+
+class Throughput:
+    """Counts processed files and bytes and reports the rate"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, nbytes=0, error=False):
+        self.files += 1
+        self.bytes += nbytes or 0
+        if error:
+            self.errors += 1
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        mb = self.bytes / (1024 * 1024)
+        return (f"{self.files} files, {mb:.1f} MB in {elapsed:.2f}s "
+                f"({self.files / elapsed:.1f} files/s, {mb / elapsed:.1f} MB/s), {self.errors} errors")
@@ -0,0 +1,279 @@
+"""Benchmarks for the metadata read, edit, strip and export paths.
+
+Generates a synthetic corpus (or reuses one) and prints the results as JSON
+so runs of different versions can be compared:
+
+    python benchmark.py -o before.json
+    python benchmark.py --corpus /tmp/corpus --large-mb 8 -o after.json
+
+Every benchmark runs in a fresh process so its peak RSS is its own;
+peak_rss_bytes is the larger of that process and its pool workers. read,
+edit and strip run on one core and report per-file latency; export runs on
+the batch process pool and reports throughput only.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, PngImagePlugin, TiffImagePlugin
+
+import batch
+import metadata_document
+import metadata_export
+import metadata_ops
+import metadata_reader
+import metadata_render
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCHMARKS = ('read', 'edit', 'strip', 'export')
+WORDS = ('masterpiece', 'portrait', 'cinematic', 'lighting', 'forest', 'castle', 'sunset', 'detailed',
+         'watercolor', 'neon', 'city', 'rain', 'fog', 'mountain', 'ocean', 'dragon', 'studio', 'bokeh')
+
+
+def _prompt(rng, words=40):
+    return ', '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _workflow(rng, target_bytes):
+    """Return a ComfyUI style prompt graph of roughly target_bytes of JSON"""
+    graph = {}
+    node_id = 1
+    size = 0
+    while size < target_bytes or node_id <= 2:
+        if node_id <= 2:
+            node = {'class_type': 'CLIPTextEncode', 'inputs': {'text': _prompt(rng), 'clip': ['4', 1]}}
+        else:
+            node = {'class_type': 'KSampler',
+                    'inputs': {'seed': rng.randrange(2 ** 32), 'steps': 30, 'cfg': 7.0,
+                               'sampler_name': 'euler', 'notes': _prompt(rng, 20)}}
+        graph[str(node_id)] = node
+        size += len(json.dumps(node)) + 8
+        node_id += 1
+    return graph
+
+
+def generate_corpus(directory, files=50, large_mb=4, seed=0):
+    """Write a reproducible set of test images to directory
+
+    Per kind: PNGs with a small prompt graph, PNGs whose prompt and
+    workflow chunks are each about large_mb MB, JPEGs with a UserComment
+    and tall TIFFs with one row per strip, which makes for large IFDs.
+    Returns the list of paths.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    small_graph = json.dumps(_workflow(rng, 2048))
+    large_graph = json.dumps(_workflow(rng, int(large_mb * 1024 * 1024)))
+    for i in range(files):
+        pixels = Image.new('RGB', (256, 256), (i % 256, 64, 128))
+
+        info = PngImagePlugin.PngInfo()
+        info.add_text('prompt', small_graph)
+        info.add_text('parameters', _prompt(rng))
+        path = os.path.join(directory, f'small_{i:05d}.png')
+        pixels.save(path, pnginfo=info)
+        paths.append(path)
+
+        # The large chunks are shared by every file, only a few files
+        # are needed to see the effect and the corpus stays small enough
+        if i < max(1, files // 10):
+            info = PngImagePlugin.PngInfo()
+            info.add_text('prompt', large_graph)
+            info.add_text('workflow', large_graph)
+            path = os.path.join(directory, f'large_{i:05d}.png')
+            pixels.save(path, pnginfo=info)
+            paths.append(path)
+
+        exif = Image.Exif()
+        exif[0x013B] = 'benchmark'  # Artist
+        exif.get_ifd(0x8769)[0x9286] = b'ASCII\0\0\0' + _prompt(rng).encode('ascii')  # UserComment
+        path = os.path.join(directory, f'photo_{i:05d}.jpg')
+        pixels.save(path, exif=exif, quality=90)
+        paths.append(path)
+
+        ifd = TiffImagePlugin.ImageFileDirectory_v2()
+        ifd[270] = _prompt(rng, 400)  # ImageDescription
+        ifd[315] = 'benchmark'  # Artist
+        path = os.path.join(directory, f'scan_{i:05d}.tif')
+        Image.new('L', (64, 4096), i % 256).save(path, tiffinfo=ifd, rowsperstrip=1)
+        paths.append(path)
+    return sorted(paths)
+
+
+def _percentile(values, fraction):
+    # Nearest rank
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _peak_rss(who='self'):
+    """Peak resident set size in bytes, or None
+
+    who='self' measures this process, who='children' the largest of its
+    finished child processes, e.g. the export pool workers.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if who == 'children' else resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _read(path, scratch):
+    meta = metadata_reader.read_metadata(path)
+    metadata_render.render(metadata_document.MetadataDocument(meta))
+
+
+def _edit(path, scratch):
+    document = metadata_document.MetadataDocument.load(path)
+    if document.format not in metadata_document.EDITABLE_FORMATS:
+        return False
+    for field in document.fields.values():
+        document.set_value(field.id, field.value + ', edited')
+        break
+    document.save(os.path.join(scratch, os.path.basename(path)))
+    return True
+
+
+def _strip(path, scratch):
+    if metadata_reader.file_format(path) not in metadata_document.EDITABLE_FORMATS:
+        return False
+    metadata_ops.strip_metadata(path, os.path.join(scratch, os.path.basename(path)))
+
+
+def _run_per_file(name, paths, repeat):
+    """Time func on every path, in this process"""
+    func = {'read': _read, 'edit': _edit, 'strip': _strip}[name]
+    scratch = tempfile.mkdtemp(prefix=f'bench-{name}-')
+    latencies = []
+    total_bytes = 0
+    try:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for path in paths:
+                t0 = time.perf_counter()
+                if func(path, scratch) is False:
+                    continue
+                latencies.append(time.perf_counter() - t0)
+                total_bytes += os.path.getsize(path)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return _result(len(latencies), total_bytes, elapsed, latencies)
+
+
+def _run_export(paths, repeat, workers):
+    start = time.perf_counter()
+    files = total_bytes = 0
+    for _ in range(repeat):
+        with open(os.devnull, 'w', encoding='utf-8', newline='') as f:
+            throughput = metadata_export.export_records(paths, f, 'jsonl', workers=workers)
+        files += throughput.files
+        total_bytes += throughput.bytes
+    return _result(files, total_bytes, time.perf_counter() - start)
+
+
+def _result(files, total_bytes, elapsed, latencies=None):
+    elapsed = max(elapsed, 1e-9)
+    result = {
+        'files': files,
+        'bytes': total_bytes,
+        'seconds': round(elapsed, 4),
+        'files_per_sec': round(files / elapsed, 1),
+        'mb_per_sec': round(total_bytes / elapsed / (1024 * 1024), 2),
+        'p50_ms': None,
+        'p99_ms': None,
+    }
+    if latencies:
+        result['p50_ms'] = round(_percentile(latencies, 0.50) * 1000, 3)
+        result['p99_ms'] = round(_percentile(latencies, 0.99) * 1000, 3)
+    return result
+
+
+def run_benchmark(name, paths, repeat=1, workers=None):
+    """Run one benchmark in this process and return its result dict"""
+    if name == 'export':
+        result = _run_export(paths, repeat, workers)
+    else:
+        result = _run_per_file(name, paths, repeat)
+    # export parses in pool workers, so their peak counts as well
+    result['peak_rss_self_bytes'] = _peak_rss('self')
+    result['peak_rss_workers_bytes'] = _peak_rss('children')
+    peaks = [peak for peak in (result['peak_rss_self_bytes'], result['peak_rss_workers_bytes']) if peak]
+    result['peak_rss_bytes'] = max(peaks) if peaks else None
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark metadata read/edit/strip/export")
+    parser.add_argument('--corpus', help="corpus folder, generated if it does not exist (default: a temporary folder)")
+    parser.add_argument('--files', type=int, default=50, help="files per kind in a generated corpus")
+    parser.add_argument('--large-mb', type=float, default=4, help="size of the large PNG text chunks in MB")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="passes over the corpus per benchmark")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes for export")
+    parser.add_argument('-b', '--benchmark', action='append', choices=BENCHMARKS,
+                        help="benchmark to run, may be repeated (default: all)")
+    parser.add_argument('-o', '--output', help="write the JSON results here instead of standard output")
+    args = parser.parse_args(argv)
+
+    temporary = None
+    corpus = args.corpus
+    if not corpus:
+        temporary = corpus = tempfile.mkdtemp(prefix='bench-corpus-')
+    try:
+        generated = not (os.path.isdir(corpus) and os.listdir(corpus))
+        if generated:
+            paths = generate_corpus(corpus, args.files, args.large_mb, args.seed)
+        else:
+            paths = sorted(batch.walk_images(corpus))
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'corpus': {
+                'files': len(paths),
+                'bytes': sum(os.path.getsize(path) for path in paths),
+                'generated': generated,
+                # The generator settings only describe a corpus made by this run
+                'files_per_kind': args.files if generated else None,
+                'large_mb': args.large_mb if generated else None,
+                'seed': args.seed if generated else None,
+            },
+            'results': {},
+        }
+        # A fresh process per benchmark keeps the peak RSS figures apart
+        context = multiprocessing.get_context('spawn')
+        for name in args.benchmark or BENCHMARKS:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(run_benchmark, name, paths, args.repeat, args.workers).result()
+            report['results'][name] = result
+            print(f"{name}: {result['files_per_sec']} files/s, {result['mb_per_sec']} MB/s", file=sys.stderr)
+    finally:
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""Persistent index of image content fingerprints for finding duplicates.
+
+The content hash covers only what determines the pixels: for PNG the
+IHDR, PLTE, tRNS and IDAT chunks, for JPEG the coding tables, frame header
+and the entropy coded scan data. Both are streamed from disk without
+decoding, so files that differ only in their metadata (an edited prompt,
+stripped EXIF) hash the same. Other formats are decoded and their pixels hashed.
+An optional perceptual tier adds a 64 bit difference hash (dHash) of a
+small grayscale thumbnail, which also matches re-encoded copies. Rows are
+keyed by path and remember the file size and mtime, like MetadataIndex.
+"""
+import hashlib
+import os
+import sys
+
+from PIL import Image
+
+import batch
+import instrumentation
+import jpeg_segments
+import metadata_reader
+import png_chunks
+import sqlite_index
+import thumbnail_cache
+
+DEFAULT_FINGERPRINT_PATH = os.path.join(os.path.expanduser('~'), '.metadata_manager', 'fingerprints.sqlite3')
+
+# PNG chunks that define the image; everything else is metadata or hints
+PNG_CONTENT_CHUNKS = (b'IHDR', b'PLTE', b'tRNS', b'IDAT')
+# The Adobe APP14 segment tells decoders which color transform was used,
+# every other APPn segment and comments are metadata
+JPEG_ADOBE = 0xEE
+READ_BUFFER_SIZE = 1024 * 1024
+# Size of the grayscale image the dHash is computed from
+DHASH_SIZE = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT,
+    dhash INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS fingerprints_content_hash ON fingerprints (content_hash);
+"""
+
+UPSERT = """
+INSERT INTO fingerprints (path, size, mtime_ns, content_hash, dhash, error)
+VALUES (:path, :size, :mtime_ns, :content_hash, :dhash, :error)
+ON CONFLICT(path) DO UPDATE SET
+    size = excluded.size, mtime_ns = excluded.mtime_ns, content_hash = excluded.content_hash,
+    dhash = excluded.dhash, error = excluded.error
+"""
+
+
+def _hash_range(f, digest, count):
+    while count > 0:
+        data = f.read(min(count, READ_BUFFER_SIZE))
+        if not data:
+            raise EOFError("Unexpected end of file")
+        digest.update(data)
+        count -= len(data)
+
+
+def _hash_png(f, digest):
+    for chunk_type, length, offset in png_chunks.iter_chunks(f):
+        if chunk_type in PNG_CONTENT_CHUNKS:
+            digest.update(chunk_type)
+            _hash_range(f, digest, length)
+
+
+def _hash_jpeg(f, digest):
+    for marker, length, offset in jpeg_segments.iter_segments(f):
+        if (jpeg_segments.APP0 <= marker <= 0xEF and marker != JPEG_ADOBE) or marker == jpeg_segments.COM:
+            continue
+        if marker in (jpeg_segments.SOS, jpeg_segments.EOI):
+            # The scans and whatever tables sit between them, to the end
+            f.seek(offset)
+            while True:
+                data = f.read(READ_BUFFER_SIZE)
+                if not data:
+                    return
+                digest.update(data)
+        digest.update(bytes((marker,)))
+        _hash_range(f, digest, length)
+
+
+def _hash_pixels(path, digest):
+    with Image.open(path) as img:
+        digest.update(f"{img.mode} {img.size[0]}x{img.size[1]}\0".encode('ascii'))
+        digest.update(img.tobytes())
+
+
+def content_hash(path):
+    """Return a hex digest of the image content of path, ignoring metadata"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        image_format = metadata_reader.detect_format(f.read(8))
+        with instrumentation.stage('fingerprint', format=image_format or 'other'):
+            if image_format == 'PNG':
+                digest.update(b'PNG\0')
+                _hash_png(f, digest)
+            elif image_format == 'JPEG':
+                digest.update(b'JPEG\0')
+                _hash_jpeg(f, digest)
+            else:
+                digest.update(b'pixels\0')
+                _hash_pixels(path, digest)
+    return digest.hexdigest()
+
+
+def dhash(path):
+    """Return the 64 bit difference hash of path as a signed integer
+
+    Each bit tells whether a pixel of a 9x8 grayscale version is brighter
+    than its right neighbour. Signed so it fits an SQLite INTEGER.
+    """
+    with instrumentation.stage('dhash'):
+        small = thumbnail_cache.make_thumbnail(path, 64).convert('L')
+        small = small.resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            i = row * (DHASH_SIZE + 1) + col
+            value = (value << 1) | (pixels[i] > pixels[i + 1])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def fingerprint_row(path, perceptual=False):
+    """Return the index row for path, for the batch process pool"""
+    st = os.stat(path)
+    row = {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+           'content_hash': None, 'dhash': None, 'error': None}
+    try:
+        row['content_hash'] = content_hash(path)
+        if perceptual:
+            row['dhash'] = dhash(path)
+    except Exception as e:
+        row['error'] = f"{type(e).__name__}: {e}"
+    return row
+
+
+def hamming_distance(a, b):
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+class FingerprintIndex(sqlite_index.SQLiteIndex):
+    """SQLite backed content fingerprints, refreshed incrementally"""
+
+    TABLE = 'fingerprints'
+    SCHEMA = SCHEMA
+    UPSERT = UPSERT
+    STALE_COLUMNS = ('size', 'mtime_ns', 'dhash', 'error')
+
+    def __init__(self, db_path=DEFAULT_FINGERPRINT_PATH):
+        super().__init__(db_path)
+
+    def stale_paths(self, paths, incomplete=None, *, perceptual=False):
+        """Return the paths missing from the index or changed on disk
+
+        With perceptual, paths stored without a dHash count as stale too.
+        """
+        def needs_refresh(row):
+            if perceptual and row['dhash'] is None and row['error'] is None:
+                return True
+            return bool(incomplete and incomplete(row))
+
+        return super().stale_paths(paths, needs_refresh)
+
+    def refresh(self, paths, perceptual=False, workers=None, progress=None):
+        """Fingerprint the stale paths on the batch process pool
+
+        Returns the list of paths that were (re)hashed. progress(done,
+        total) is called as results come in.
+        """
+        stale = self.stale_paths(paths, perceptual=perceptual)
+        rows = []
+        items = ((path, perceptual) for path in stale)
+        for done, (item, row, error) in enumerate(batch.imap_chunked(fingerprint_row, items, workers=workers), 1):
+            if error:
+                # The file vanished since stale_paths() looked at it
+                print(f"Warning: Could not fingerprint {item[0]}: {error}", file=sys.stderr)
+            else:
+                rows.append(row)
+            if len(rows) >= sqlite_index.COMMIT_BATCH_SIZE:
+                self._store_rows(rows)
+                rows = []
+            if progress:
+                progress(done, len(stale))
+        if rows:
+            self._store_rows(rows)
+        return stale
+
+    def duplicate_groups(self, paths):
+        """Return lists of paths with the same content hash, largest group first"""
+        groups = {}
+        for path, row in self.stored_rows(paths, ('content_hash',)).items():
+            if row['content_hash'] is not None:
+                groups.setdefault(row['content_hash'], []).append(path)
+        return _sorted_groups(groups.values())
+
+    def similar_groups(self, paths, max_distance=4):
+        """Return lists of paths linked by dHashes at most max_distance bits apart
+
+        Groups are chains (single linkage): every member is within the
+        distance of some other member, but two members can be further apart
+        than that. Two hashes within the distance agree exactly on at least
+        one of max_distance + 1 disjoint bit bands, so only hashes sharing a
+        band are compared, rather than every pair. At 64 bits every pair is
+        within the distance.
+        """
+        hashes = [(path, row['dhash']) for path, row in self.stored_rows(paths, ('dhash',)).items()
+                  if row['dhash'] is not None]
+        if max_distance >= 64:
+            return _sorted_groups([[path for path, value in hashes]])
+        parent = list(range(len(hashes)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        bands = max_distance + 1
+        width = 64 // bands
+        for band in range(bands):
+            shift = band * width
+            # The last band takes the bits left over by the division
+            mask = (1 << (64 - shift if band == bands - 1 else width)) - 1
+            buckets = {}
+            for i, (path, value) in enumerate(hashes):
+                buckets.setdefault(((value & 0xFFFFFFFFFFFFFFFF) >> shift) & mask, []).append(i)
+            for members in buckets.values():
+                for a in range(len(members)):
+                    for b in range(a + 1, len(members)):
+                        i, j = members[a], members[b]
+                        if find(i) != find(j) and hamming_distance(hashes[i][1], hashes[j][1]) <= max_distance:
+                            parent[find(i)] = find(j)
+        groups = {}
+        for i, (path, value) in enumerate(hashes):
+            groups.setdefault(find(i), []).append(path)
+        return _sorted_groups(groups.values())
+
+
+def _sorted_groups(groups):
+    return sorted((sorted(group) for group in groups if len(group) > 1), key=lambda group: (-len(group), group[0]))
@@ -0,0 +1,253 @@
+"""Watches a folder tree for new and modified images.
+
+On Linux the kernel's inotify interface is used through ctypes, so an idle
+watch costs nothing but a blocked thread. Elsewhere, or when inotify is not
+available, directories are polled: only their mtimes are checked each
+round, and a directory is listed again only when its mtime changed.
+Changes are collected and handed over in debounced batches.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+import batch
+
+# How long the tree has to be quiet before a batch is delivered, and the
+# longest a change waits while files keep arriving
+DEBOUNCE_SECONDS = 0.5
+MAX_LATENCY_SECONDS = 2.0
+POLL_INTERVAL_SECONDS = 2.0
+# When polling, how many unchanged directories are listed again each round,
+# taking turns, to catch files rewritten in place, which leaves their
+# directory's mtime alone
+RECHECK_DIRECTORIES = 8
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def _subdirectories(directory):
+    """Yield directory and every directory below it"""
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        yield current
+        try:
+            with os.scandir(current) as entries:
+                stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+        except OSError:
+            pass
+
+
+class FolderWatcher:
+    """Reports new and modified image files below a directory
+
+    on_batch(paths) is called from the watcher thread with a list of paths,
+    at most every DEBOUNCE_SECONDS while the tree is busy. Files that exist
+    when the watch starts are not reported unless they change. When
+    polling, a file rewritten in place (rather than replaced) leaves its
+    directory's mtime alone; it is noticed within two poll intervals while
+    it is new, and otherwise once its directory's turn comes round: every
+    poll lists recheck_directories unchanged directories again, so a tree
+    of n directories is covered every n / recheck_directories polls.
+    """
+
+    def __init__(self, directory, on_batch, use_inotify=True, poll_interval=POLL_INTERVAL_SECONDS,
+                 recheck_directories=RECHECK_DIRECTORIES):
+        self.directory = directory
+        self.on_batch = on_batch
+        self.poll_interval = poll_interval
+        self.recheck_directories = recheck_directories
+        self.libc = _load_inotify() if use_inotify else None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.pending = {}
+        self.first_change = None
+        self.last_change = None
+
+    @property
+    def mode(self):
+        return 'inotify' if self.libc else 'polling'
+
+    def start(self):
+        target = self._run_inotify if self.libc else self._run_polling
+        self.thread = threading.Thread(target=target, name='folder-watch', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+    def _changed(self, path):
+        if batch.is_image_path(path) and not os.path.basename(path).startswith('.'):
+            now = time.monotonic()
+            self.pending[path] = None
+            self.first_change = self.first_change or now
+            self.last_change = now
+
+    def _flush(self, force=False):
+        """Deliver pending paths once things settled down, return the wait left"""
+        if not self.pending:
+            return None
+        now = time.monotonic()
+        quiet_for = now - self.last_change
+        if force or quiet_for >= DEBOUNCE_SECONDS or now - self.first_change >= MAX_LATENCY_SECONDS:
+            paths = list(self.pending)
+            self.pending.clear()
+            self.first_change = self.last_change = None
+            self.on_batch(paths)
+            return None
+        return DEBOUNCE_SECONDS - quiet_for
+
+    # inotify
+
+    def _run_inotify(self):
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            print(f"Warning: inotify unavailable ({os.strerror(ctypes.get_errno())}), polling instead")
+            self.libc = None
+            return self._run_polling()
+        watches = {}
+        try:
+            for directory in _subdirectories(self.directory):
+                self._add_watch(fd, watches, directory)
+            while not self.stop_event.is_set():
+                wait = self._flush()
+                timeout = 0.5 if wait is None else min(wait, 0.5)
+                readable, _, _ = select.select([fd], [], [], timeout)
+                if readable:
+                    self._read_events(fd, watches)
+        finally:
+            os.close(fd)
+
+    def _add_watch(self, fd, watches, directory):
+        wd = self.libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error != errno.ENOENT:
+                print(f"Warning: Could not watch {directory}: {os.strerror(error)}")
+            return
+        watches[wd] = directory
+
+    def _read_events(self, fd, watches):
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].split(b'\0', 1)[0]
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, pick up whatever is in the tree now
+                for path in batch.walk_images(self.directory):
+                    self._changed(path)
+                continue
+            if mask & IN_IGNORED:
+                watches.pop(wd, None)
+                continue
+            directory = watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may land in a new folder before its watch exists
+                    for subdirectory in _subdirectories(path):
+                        self._add_watch(fd, watches, subdirectory)
+                    for image in batch.walk_images(path):
+                        self._changed(image)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._changed(path)
+
+    # Polling
+
+    def _run_polling(self):
+        # directory -> (mtime_ns, {name: (size, mtime_ns)}) of its files
+        snapshots = {}
+        for directory in _subdirectories(self.directory):
+            snapshots[directory] = self._snapshot(directory)
+        cursor = 0
+        while not self.stop_event.wait(self.poll_interval):
+            directories = list(snapshots)
+            # The unchanged directories whose turn it is to be listed again
+            cursor %= len(directories) or 1
+            recheck = directories[cursor:cursor + self.recheck_directories]
+            recheck += directories[:self.recheck_directories - len(recheck)]
+            recheck = set(recheck)
+            cursor += self.recheck_directories
+            for directory in directories:
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except OSError:
+                    del snapshots[directory]
+                    continue
+                if directory in recheck or mtime_ns != snapshots[directory][0]:
+                    self._rescan(directory, snapshots)
+            self._flush(force=True)
+
+    def _snapshot(self, directory, subdirectories=None):
+        files = {}
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if subdirectories is not None:
+                            subdirectories.append(entry.path)
+                    elif batch.is_image_path(entry.name):
+                        st = entry.stat()
+                        files[entry.name] = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            return (None, {})
+        return (mtime_ns, files)
+
+    def _rescan(self, directory, snapshots):
+        old_files = snapshots[directory][1]
+        subdirectories = []
+        snapshots[directory] = snapshot = self._snapshot(directory, subdirectories)
+        for name, stat in snapshot[1].items():
+            if old_files.get(name) != stat:
+                self._changed(os.path.join(directory, name))
+        # Writing into a file does not touch the directory mtime, so keep
+        # listing a directory while its files may still be growing
+        recent = time.time_ns() - int(2 * self.poll_interval * 1e9)
+        if any(mtime_ns > recent for size, mtime_ns in snapshot[1].values()):
+            snapshots[directory] = (None, snapshot[1])
+        for subdirectory in subdirectories:
+            if subdirectory not in snapshots:
+                for new_directory in _subdirectories(subdirectory):
+                    snapshots[new_directory] = self._snapshot(new_directory)
+                    for name in snapshots[new_directory][1]:
+                        self._changed(os.path.join(new_directory, name))
@@ -0,0 +1,203 @@
+"""Per-stage timing, counters and optional profiling.
+
+The read, edit and save paths wrap their stages (open, decode_headers,
+json_parse, render, encode, write, fsync) in stage() blocks. Each stage
+feeds a histogram of its durations. With METADATA_MANAGER_LOG set, every
+stage and event is also appended to that file as a JSON line. With
+METADATA_MANAGER_PROFILE set, the calling thread is profiled with cProfile
+until exit and the stats are dumped to that file. Statistics are per
+process; batch pool workers keep their own but log to the same file.
+"""
+import atexit
+import bisect
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+ENV_LOG = 'METADATA_MANAGER_LOG'
+ENV_PROFILE = 'METADATA_MANAGER_PROFILE'
+# Histogram bucket upper bounds in milliseconds, the last bucket is open
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """Bucketed durations of one stage, in milliseconds"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 3) if self.count else None,
+            'p50_ms': self.percentile(0.50),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max, 3),
+        }
+
+
+class Stats:
+    """Thread safe collection of stage histograms and counters"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        # Per thread {stage: ms} dicts filled by capture()
+        self.local = threading.local()
+        self.log_file = None
+        self.profiler = None
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """Time the block as stage name, fields go to the log line"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, **fields)
+
+    @contextlib.contextmanager
+    def capture(self):
+        """Collect the stages the calling thread runs in the block
+
+        Yields a dict of stage name -> total milliseconds. Only this
+        thread's stages end up in it, whatever other threads are timing.
+        """
+        outer = getattr(self.local, 'captured', None)
+        captured = self.local.captured = {}
+        try:
+            yield captured
+        finally:
+            self.local.captured = outer
+            if outer is not None:
+                for name, ms in captured.items():
+                    outer[name] = outer.get(name, 0.0) + ms
+
+    def record(self, name, seconds, **fields):
+        ms = seconds * 1000
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(ms)
+        captured = getattr(self.local, 'captured', None)
+        if captured is not None:
+            captured[name] = captured.get(name, 0.0) + ms
+        if self.log_file:
+            self._log({'stage': name, 'ms': round(ms, 3), **fields})
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def event(self, name, **fields):
+        """Count an event and log it with its details"""
+        self.count(name)
+        if self.log_file:
+            self._log({'event': name, **fields})
+
+    def snapshot(self):
+        """Return the counters and stage summaries as a plain dict"""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {name: h.summary() for name, h in sorted(self.histograms.items())},
+            }
+
+    def summary_lines(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, s in snapshot['stages'].items():
+            lines.append(f"{name}: {s['count']} x, mean {s['mean_ms']} ms, "
+                         f"p50 <= {s['p50_ms']} ms, p99 <= {s['p99_ms']} ms, max {s['max_ms']} ms")
+        for name, n in sorted(snapshot['counters'].items()):
+            lines.append(f"{name}: {n}")
+        return lines
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def open_log(self, path):
+        """Append stage timings and events to path as JSON lines"""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Line buffered appends keep lines from several processes whole
+        self.log_file = open(path, 'a', encoding='utf-8', buffering=1)
+
+    def _log(self, record):
+        record = {'ts': round(time.time(), 6), 'pid': os.getpid(), **record}
+        line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+        with self.lock:
+            if self.log_file:
+                self.log_file.write(line)
+
+    def start_profile(self):
+        """Start profiling the calling thread with cProfile"""
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop_profile(self, path):
+        """Stop profiling and dump the stats to path (see pstats)"""
+        if self.profiler is None:
+            return None
+        self.profiler.disable()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.profiler.dump_stats(path)
+        self.profiler = None
+        return path
+
+    @property
+    def profiling(self):
+        return self.profiler is not None
+
+
+stats = Stats()
+stage = stats.stage
+capture = stats.capture
+count = stats.count
+event = stats.event
+
+
+def configure_from_env(profile=True):
+    """Set up logging and profiling from the environment, for entry points"""
+    log_path = os.environ.get(ENV_LOG)
+    if log_path and not stats.log_file:
+        stats.open_log(log_path)
+    profile_path = os.environ.get(ENV_PROFILE)
+    if profile and profile_path and not stats.profiling:
+        stats.start_profile()
+        atexit.register(stats.stop_profile, profile_path)
+
+
+def configure_worker():
+    """Process pool initializer: log like the parent, but never profile"""
+    configure_from_env(profile=False)
@@ -0,0 +1,265 @@
+"""Marker segment level JPEG reading and writing.
+
+Metadata lives in APPn segments in front of the scan data, so it can be
+replaced by copying the entropy coded data verbatim, without recompressing.
+"""
+import shutil
+import struct
+
+import piexif
+import piexif.helper
+
+from atomic_file import atomic_write
+
+SOI = 0xD8
+EOI = 0xD9
+SOS = 0xDA
+APP0 = 0xE0
+APP1 = 0xE1
+APP2 = 0xE2
+APP13 = 0xED
+COM = 0xFE
+EXIF_HEADER = b'Exif\0\0'
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\0'
+XMP_EXTENSION_HEADER = b'http://ns.adobe.com/xmp/extension/\0'
+ICC_HEADER = b'ICC_PROFILE\0'
+IPTC_HEADER = b'Photoshop 3.0\0'
+MAX_SEGMENT_DATA = 65533
+
+# Markers without a length field: RST0-RST7, TEM and SOI
+_STANDALONE_MARKERS = set(range(0xD0, 0xD8)) | {0x01, SOI}
+
+# ASCII and UNDEFINED, the EXIF types that can be set from text
+TEXT_TAG_TYPES = (piexif.TYPES.Ascii, piexif.TYPES.Undefined)
+
+# Tag name -> (IFD, tag id) for the tags that can be edited by name
+EXIF_FIELDS = {}
+for _ifd in ('Exif', '0th'):
+    for _tag, _info in piexif.TAGS[_ifd].items():
+        EXIF_FIELDS[_info['name']] = (_ifd, _tag)
+# Names of the ASCII typed tags, whose values are text in any file
+ASCII_FIELDS = {name for name, (ifd, tag) in EXIF_FIELDS.items()
+                if piexif.TAGS[ifd][tag]['type'] == piexif.TYPES.Ascii}
+
+
+class JpegFormatError(ValueError):
+    """Raised when a file is not a well formed JPEG stream"""
+
+
+def read_exact(f, count):
+    """Read exactly count bytes or raise JpegFormatError"""
+    data = f.read(count)
+    if len(data) != count:
+        raise JpegFormatError("Unexpected end of JPEG data")
+    return data
+
+
+def iter_segments(f):
+    """Walk the marker segments of an open JPEG file up to the first scan
+
+    Yields (marker, length, offset) where offset is the position of the
+    marker and length the size of the segment payload. The file is left
+    positioned at the start of the payload. The walk ends after the SOS
+    segment (or EOI), since everything after it is entropy coded data.
+    """
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        raise JpegFormatError("Not a JPEG file")
+    offset = 2
+    while True:
+        f.seek(offset)
+        if f.read(1) != b'\xff':
+            raise JpegFormatError(f"Expected a marker at offset {offset}")
+        marker = f.read(1)
+        while marker == b'\xff':  # Fill bytes before the marker
+            offset += 1
+            marker = f.read(1)
+        if not marker:
+            raise JpegFormatError("Unexpected end of JPEG data")
+        marker = marker[0]
+        if marker in _STANDALONE_MARKERS or marker == EOI:
+            yield marker, 0, offset
+            if marker == EOI:
+                return
+            offset += 2
+            continue
+        length = struct.unpack('>H', read_exact(f, 2))[0] - 2
+        if length < 0:
+            raise JpegFormatError(f"Invalid segment length at offset {offset}")
+        yield marker, length, offset
+        if marker == SOS:
+            return
+        offset += length + 4
+
+
+def make_segment(marker, data):
+    """Serialize a marker segment including its length field"""
+    if len(data) > MAX_SEGMENT_DATA:
+        raise JpegFormatError(f"Segment data too large ({len(data)} bytes, limit is {MAX_SEGMENT_DATA})")
+    return struct.pack('>BBH', 0xFF, marker, len(data) + 2) + data
+
+
+def read_exif(f):
+    """Return the raw APP1 EXIF payload (starting with Exif\\0\\0) or None"""
+    for marker, length, offset in iter_segments(f):
+        if marker == APP1 and length >= len(EXIF_HEADER):
+            data = read_exact(f, length)
+            if data.startswith(EXIF_HEADER):
+                return data
+    return None
+
+
+def write_exif(src_path, dst_path, exif, fsync=False):
+    """Copy a JPEG file replacing its APP1 EXIF segment
+
+    exif is a full APP1 payload as returned by piexif.dump(), or None to
+    drop the EXIF segment. A new segment goes right after SOI/APP0. All
+    other segments and the scan data are copied byte for byte.
+    src_path and dst_path may be the same file.
+    """
+    written = exif is None
+    with atomic_write(dst_path, fsync=fsync) as dst:
+        with open(src_path, 'rb') as src:
+            dst.write(b'\xff\xd8')
+            for marker, length, offset in iter_segments(src):
+                if marker == APP1 and length >= len(EXIF_HEADER):
+                    data = read_exact(src, length)
+                    if data.startswith(EXIF_HEADER):
+                        if not written:
+                            dst.write(make_segment(APP1, exif))
+                            written = True
+                        continue
+                    dst.write(make_segment(APP1, data))
+                    continue
+                if not written and marker != APP0:
+                    dst.write(make_segment(APP1, exif))
+                    written = True
+                src.seek(offset)
+                if marker in (SOS, EOI):
+                    # Scan header, entropy coded data and any later scans
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                    break
+                header_size = 2 if marker in _STANDALONE_MARKERS else 4
+                dst.write(read_exact(src, length + header_size))
+
+
+def remove_segments(src_path, dst_path, drop, fsync=False):
+    """Copy a JPEG file leaving out the segments selected by drop
+
+    drop(marker, data) is called for every APPn and COM segment in front of
+    the first scan and returns True to leave the segment out. Returns the
+    number of segments removed; the scan data is copied byte for byte.
+    """
+    removed = 0
+    with atomic_write(dst_path, fsync=fsync) as dst:
+        with open(src_path, 'rb') as src:
+            dst.write(b'\xff\xd8')
+            for marker, length, offset in iter_segments(src):
+                if APP0 <= marker <= 0xEF or marker == COM:
+                    data = read_exact(src, length)
+                    if drop(marker, data):
+                        removed += 1
+                        continue
+                    dst.write(make_segment(marker, data))
+                    continue
+                src.seek(offset)
+                if marker in (SOS, EOI):
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                    break
+                header_size = 2 if marker in _STANDALONE_MARKERS else 4
+                dst.write(read_exact(src, length + header_size))
+    return removed
+
+
+def encode_user_comment(text):
+    """Encode text as an EXIF UserComment with the proper character code prefix"""
+    try:
+        text.encode('ascii')
+        return piexif.helper.UserComment.dump(text, encoding='ascii')
+    except UnicodeEncodeError:
+        return piexif.helper.UserComment.dump(text, encoding='unicode')
+
+
+def decode_user_comment(value):
+    """Decode a raw EXIF UserComment value into text
+
+    Handles the 8 byte character code prefix from the EXIF spec as well as
+    the prefix-less UTF-8 some tools write.
+    """
+    if not isinstance(value, bytes):
+        return str(value)
+    prefix, body = value[:8], value[8:]
+    if prefix == b'ASCII\0\0\0':
+        return body.decode('ascii', 'replace').rstrip('\0')
+    if prefix == b'UNICODE\0':
+        # The byte order follows the TIFF header, which is not known here;
+        # guess it from where the zero bytes of ASCII characters sit
+        if len(body) >= 2 and body[0] == 0 and body[1] != 0:
+            encoding = 'utf-16-be'
+        elif len(body) >= 2 and body[1] == 0 and body[0] != 0:
+            encoding = 'utf-16-le'
+        else:
+            encoding = 'utf-16-be'
+        return body.decode(encoding, 'replace').rstrip('\0')
+    if prefix == b'JIS\0\0\0\0\0':
+        return body.decode('shift_jis', 'replace').rstrip('\0')
+    if prefix == b'\0' * 8:
+        value = body
+    try:
+        return value.decode('utf-8').rstrip('\0')
+    except UnicodeDecodeError:
+        return value.decode('latin-1').rstrip('\0')
+
+
+def _empty_exif_dict():
+    return {'0th': {}, 'Exif': {}, 'GPS': {}, 'Interop': {}, '1st': {}, 'thumbnail': None}
+
+
+def _undefined_to_bytes(exif_dict):
+    """Turn UNDEFINED values piexif.load() returned as int or tuple into bytes
+
+    Writers such as Pillow store UNDEFINED tags with a numeric type, which
+    piexif.load() hands back as numbers but piexif.dump() only takes as bytes.
+    """
+    for ifd in ('0th', 'Exif', 'GPS', 'Interop', '1st'):
+        tags = exif_dict.get(ifd) or {}
+        for tag, value in tags.items():
+            info = piexif.TAGS[ifd].get(tag)
+            if info is None or info['type'] != piexif.TYPES.Undefined:
+                continue
+            if isinstance(value, int):
+                tags[tag] = bytes([value])
+            elif isinstance(value, tuple):
+                tags[tag] = bytes(value)
+
+
+def update_exif_fields(src_path, dst_path, fields, fsync=False):
+    """Copy a JPEG file setting EXIF tags by name
+
+    fields maps tag names from IFD0 or the Exif IFD (UserComment, Artist,
+    Copyright, ImageDescription, ...) to text; None removes the tag. Only the
+    APP1 segment is rebuilt, the image data is never recompressed.
+    """
+    with open(src_path, 'rb') as f:
+        raw = read_exif(f)
+    if not fields:
+        exif = raw
+    else:
+        exif_dict = piexif.load(raw) if raw else _empty_exif_dict()
+        for name, value in fields.items():
+            if name not in EXIF_FIELDS:
+                raise ValueError(f"Unknown EXIF tag: {name}")
+            ifd, tag = EXIF_FIELDS[name]
+            if isinstance(value, str) and piexif.TAGS[ifd][tag]['type'] not in TEXT_TAG_TYPES:
+                raise ValueError(f"EXIF tag {name} does not hold text")
+            if value is None:
+                exif_dict[ifd].pop(tag, None)
+            elif name == 'UserComment':
+                exif_dict[ifd][tag] = encode_user_comment(value)
+            elif isinstance(value, str):
+                exif_dict[ifd][tag] = value.encode('utf-8')
+            else:
+                exif_dict[ifd][tag] = value
+        _undefined_to_bytes(exif_dict)
+        exif = piexif.dump(exif_dict)
+    write_exif(src_path, dst_path, exif, fsync=fsync)
@@ -0,0 +1,201 @@
+"""Background metadata loading for the viewer.
+
+Parsing runs on a small thread pool and finished results are put on a
+queue that the Tk main thread polls, so no Tk call ever happens off the
+main thread. Parsed metadata is kept in an LRU cache bounded by an
+estimate of its memory use.
+"""
+import collections
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+import metadata_reader
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_WORKERS = 2
+# List entries prefetched on either side of the selected one
+DEFAULT_PREFETCH = 4
+# Rough per object overhead used by the size estimate
+ENTRY_OVERHEAD = 1024
+VALUE_OVERHEAD = 64
+# Memory of a decoded prompt graph per character of its JSON text. Dicts,
+# small strings and numbers make the parsed graph about three times as
+# large as the text it came from.
+GRAPH_FACTOR = 3
+
+
+def _value_size(value):
+    if isinstance(value, (str, bytes)):
+        return VALUE_OVERHEAD + len(value)
+    if isinstance(value, (tuple, list)):
+        return VALUE_OVERHEAD + sum(_value_size(v) for v in value)
+    if isinstance(value, dict):
+        return VALUE_OVERHEAD + sum(_value_size(k) + _value_size(v) for k, v in value.items())
+    return VALUE_OVERHEAD
+
+
+def estimate_size(meta):
+    """Estimate the memory held by an ImageMetadata, in bytes
+
+    Text chunks share their value strings with meta.text, so only the
+    latter is counted. The decoded prompt graph is charged by the length of
+    its JSON text, as the loader always decodes it before caching.
+    """
+    size = ENTRY_OVERHEAD + _value_size(meta.text) + _value_size(meta.exif)
+    prompt = meta.text.get('prompt')
+    if isinstance(prompt, str):
+        size += GRAPH_FACTOR * len(prompt)
+    size += len(meta.text_chunks) * VALUE_OVERHEAD
+    size += len(meta.xmp or '') + len(meta.comment or '')
+    return size
+
+
+class MetadataCache:
+    """Thread safe LRU cache of parsed metadata, bounded by memory use
+
+    Entries are checked against the file's size and mtime on lookup, so a
+    file changed on disk is never served from the cache.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # path -> (meta, size estimate), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        """Return the cached metadata of path, or None if missing or stale"""
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None:
+            return None
+        meta = entry[0]
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return None
+        if (st.st_size, st.st_mtime_ns) != (meta.file_size, meta.mtime_ns):
+            self.invalidate(path)
+            return None
+        with self.lock:
+            if path in self.entries:
+                self.entries.move_to_end(path)
+        return meta
+
+    def put(self, meta):
+        size = estimate_size(meta)
+        with self.lock:
+            self._remove(meta.path)
+            # A single entry larger than the whole budget is not kept
+            if size > self.max_bytes:
+                return
+            self.entries[meta.path] = (meta, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                path, (old, old_size) = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+
+    def invalidate(self, path):
+        with self.lock:
+            self._remove(path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+
+class MetadataLoader:
+    """Loads metadata on worker threads for a UI that shows one file at a time
+
+    request() names the file the UI wants to show plus files to prefetch.
+    Each request bumps a generation counter and cancels the work queued for
+    earlier requests, so quickly moving through a list only parses what is
+    still wanted. Results come back through poll(), which the UI thread
+    calls periodically (e.g. from window.after).
+    """
+
+    def __init__(self, cache=None, workers=DEFAULT_WORKERS):
+        self.cache = cache if cache is not None else MetadataCache()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='metadata')
+        self.results = queue.Queue()
+        self.generation = 0
+        # (generation, path) the UI is currently waiting for
+        self.wanted = (0, None)
+        self.delivered = 0
+        self.pending = []
+
+    def request(self, path, prefetch=()):
+        """Ask for the metadata of path, return it right away if it is cached
+
+        Otherwise returns None and the result is delivered by poll().
+        """
+        self.generation += 1
+        self.wanted = (self.generation, path)
+        # Work queued for earlier requests is no longer wanted; tasks that
+        # already started finish and still land in the cache
+        for future in self.pending:
+            future.cancel()
+        self.pending = []
+
+        meta = self.cache.get(path)
+        if meta is not None:
+            self.delivered = self.generation
+        else:
+            self.pending.append(self.executor.submit(self._load, path))
+        for other in prefetch:
+            if other != path and self.cache.get(other) is None:
+                self.pending.append(self.executor.submit(self._load, other))
+        return meta
+
+    def poll(self):
+        """Return (path, meta, error, timings) for the current request if it finished
+
+        timings maps the stages of this load (open, decode_headers,
+        json_parse) to milliseconds. Returns None while the result is
+        outstanding or was already delivered. Results for superseded
+        requests are dropped.
+        """
+        result = None
+        while True:
+            try:
+                path, meta, error, timings = self.results.get_nowait()
+            except queue.Empty:
+                break
+            wanted_generation, wanted_path = self.wanted
+            if path == wanted_path and self.delivered != wanted_generation:
+                self.delivered = wanted_generation
+                result = (path, meta, error, timings)
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _load(self, path):
+        try:
+            with instrumentation.capture() as timings:
+                meta = metadata_reader.read_metadata(path)
+                # Decode the prompt graph here rather than on the UI thread
+                meta.workflow()
+        except Exception as e:
+            meta, error = None, str(e)
+        else:
+            self.cache.put(meta)
+            error = None
+        # Only the file the UI is waiting for is reported, prefetched
+        # files just fill the cache
+        if path == self.wanted[1]:
+            self.results.put((path, meta, error, timings))
@@ -0,0 +1,299 @@
+"""Command line interface for bulk metadata processing.
+
+Runs without a display and spreads the work over a process pool:
+
+    python metadata_cli.py strip outputs/ -o clean/
+    python metadata_cli.py set --field Artist=me --remove parameters "renders/**/*.png"
+    python metadata_cli.py copy --from reference.png --key parameters outputs/
+    python metadata_cli.py recompress --threshold 4096 archive/
+    python metadata_cli.py replace --find "old lora" --replace "new lora" --dry-run outputs/
+    python metadata_cli.py export outputs/ -o metadata.jsonl
+    python metadata_cli.py export --format csv archive/ > metadata.csv
+    python metadata_cli.py duplicates --perceptual library/
+"""
+import argparse
+import functools
+import os
+import re
+import sys
+import time
+
+import batch
+import fingerprint_index
+import instrumentation
+import metadata_export
+import metadata_index
+import metadata_ops
+import metadata_replace
+import png_chunks
+
+
+def _targets(args):
+    """Return (path, target) pairs for the input paths of a write command
+
+    With --output, two sources that would land on the same target are an
+    error, as one result would silently replace the other.
+    """
+    if not args.output:
+        return ((path, path) for path, relative in batch.iter_image_paths(args.paths))
+    targets = []
+    sources = {}
+    for path, relative in batch.iter_image_paths(args.paths):
+        target = os.path.join(args.output, relative)
+        key = os.path.normcase(os.path.abspath(target))
+        if key in sources:
+            raise SystemExit(f"error: {sources[key]} and {path} would both be written to {target}")
+        sources[key] = path
+        targets.append((path, target))
+    return targets
+
+
+def _run(func, items, args, report=None):
+    """Run func over items in the pool, report errors and throughput
+
+    report(item, result), if given, is called with every successful result
+    and returns the number of bytes processed; otherwise the result is.
+
+    --fsync file syncs every file before it replaces the original,
+    --fsync batch syncs the filesystems once per batch.SYNC_BATCH_SIZE files
+    instead, falling back to per file syncs where os.sync() is missing.
+    """
+    batched_sync = args.fsync == 'batch' and hasattr(os, 'sync')
+    if args.fsync == 'file' or (args.fsync == 'batch' and not batched_sync):
+        func = functools.partial(func, fsync=True)
+    throughput = batch.Throughput()
+    for item, result, error in batch.imap_chunked(func, items, workers=args.workers, chunksize=args.chunksize):
+        if error:
+            print(f"{item[0]}: {error}", file=sys.stderr)
+        elif report:
+            result = report(item, result)
+        throughput.add(result, error=bool(error))
+        if batched_sync and throughput.files % batch.SYNC_BATCH_SIZE == 0:
+            batch.sync_filesystems()
+    if batched_sync:
+        batch.sync_filesystems()
+    if not args.quiet:
+        print(throughput.summary(), file=sys.stderr)
+    return 1 if throughput.errors else 0
+
+
+def _policy(args):
+    """The PNG text compression chosen with --threshold and --level"""
+    return png_chunks.CompressionPolicy(args.threshold, args.level)
+
+
+def _parse_fields(args):
+    fields = {}
+    for field in args.field or []:
+        key, sep, value = field.partition('=')
+        if not sep or not key:
+            raise SystemExit(f"error: --field expects KEY=VALUE, got {field!r}")
+        fields[key] = value
+    for key in args.remove or []:
+        fields[key] = None
+    return fields
+
+
+def cmd_strip(args):
+    try:
+        categories = metadata_ops.parse_categories(args.categories)
+    except ValueError as e:
+        raise SystemExit(f"error: {e}")
+    func = functools.partial(metadata_ops.strip_metadata, categories=categories)
+    return _run(func, _targets(args), args)
+
+
+def cmd_set(args):
+    fields = _parse_fields(args)
+    if not fields:
+        raise SystemExit("error: nothing to set, use --field and/or --remove")
+    func = functools.partial(metadata_ops.set_fields, fields=fields, policy=_policy(args))
+    return _run(func, _targets(args), args)
+
+
+def cmd_copy(args):
+    try:
+        fields = metadata_ops.source_fields(args.source, args.key)
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"error: {e}")
+    func = functools.partial(metadata_ops.set_fields, fields=fields, policy=_policy(args))
+    return _run(func, _targets(args), args)
+
+
+def cmd_recompress(args):
+    func = functools.partial(metadata_ops.recompress_metadata, threshold=args.threshold, level=args.level)
+    return _run(func, _targets(args), args)
+
+
+def cmd_replace(args):
+    try:
+        replacement = metadata_replace.Replacement(
+            args.find, args.replace, regex=args.regex, ignore_case=args.ignore_case)
+    except (ValueError, re.error) as e:
+        raise SystemExit(f"error: {e}")
+    if args.dry_run:
+        args.fsync = 'none'
+    func = functools.partial(metadata_replace.replace_in_file, replacement=replacement,
+                             dry_run=args.dry_run, policy=_policy(args))
+    totals = {'files': 0, 'replacements': 0}
+
+    def report(item, result):
+        size, changes = result
+        if changes:
+            count = sum(change.count for change in changes)
+            totals['files'] += 1
+            totals['replacements'] += count
+            if args.dry_run:
+                for change in changes:
+                    print(change.diff)
+            else:
+                print(f"{item[0]}: {count} replacement(s) in {', '.join(change.field for change in changes)}")
+        return size
+
+    status = _run(func, _targets(args), args, report=report)
+    if not args.quiet:
+        verb = "would change" if args.dry_run else "changed"
+        print(f"{totals['replacements']} replacement(s), {totals['files']} file(s) {verb}", file=sys.stderr)
+    return status
+
+
+def cmd_export(args):
+    export_format = args.format or metadata_export.format_for_path(args.output)
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        index = None if args.no_index else metadata_index.MetadataIndex(args.index)
+        paths = (path for path, relative in batch.iter_image_paths(args.paths))
+        try:
+            throughput = metadata_export.export_records(
+                paths, out, export_format, workers=args.workers, chunksize=args.chunksize,
+                on_error=lambda path, error: print(f"{path}: {error}", file=sys.stderr), index=index)
+        finally:
+            if index is not None:
+                index.close()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if not args.quiet:
+        print(throughput.summary(), file=sys.stderr)
+    return 1 if throughput.errors else 0
+
+
+def cmd_duplicates(args):
+    paths = [path for path, relative in batch.iter_image_paths(args.paths)]
+    perceptual = args.perceptual or args.distance is not None
+    index = fingerprint_index.FingerprintIndex(args.index)
+    try:
+        start = time.perf_counter()
+        hashed = index.refresh(paths, perceptual=perceptual, workers=args.workers)
+        groups = [('identical', group) for group in index.duplicate_groups(paths)]
+        if perceptual:
+            distance = 4 if args.distance is None else args.distance
+            identical = {frozenset(group) for kind, group in groups}
+            for group in index.similar_groups(paths, distance):
+                # A group of nothing but one set of identical files was listed already
+                if frozenset(group) not in identical:
+                    groups.append((f"similar (linked at distance <= {distance})", group))
+    finally:
+        index.close()
+    for kind, group in groups:
+        print(f"# {kind}, {len(group)} files")
+        for path in group:
+            print(path)
+        print()
+    if not args.quiet:
+        print(f"{len(paths)} files, {len(hashed)} fingerprinted in {time.perf_counter() - start:.2f}s, "
+              f"{len(groups)} duplicate group(s)", file=sys.stderr)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Bulk image metadata processing")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('paths', nargs='+', help="image files, directories (walked recursively) or glob patterns")
+    common.add_argument('-j', '--workers', type=int, default=None,
+                        help="worker processes (default: number of CPUs, 1 runs in-process)")
+    common.add_argument('--chunksize', type=int, default=batch.DEFAULT_CHUNKSIZE,
+                        help="files handed to a worker at a time")
+    common.add_argument('-q', '--quiet', action='store_true', help="do not print the throughput summary")
+
+    write = argparse.ArgumentParser(add_help=False)
+    write.add_argument('-o', '--output', help="write results below this folder instead of overwriting the originals")
+    write.add_argument('--fsync', choices=('none', 'file', 'batch'), default='none',
+                       help="flush written files to disk: never, per file, or per batch of files")
+
+    # PNG text compression of the commands that write new values
+    compression = argparse.ArgumentParser(add_help=False)
+    compression.add_argument('--threshold', type=int, default=png_chunks.COMPRESS_THRESHOLD,
+                             help="store PNG text values of at least this many bytes compressed "
+                                  "(default: %(default)s)")
+    compression.add_argument('--level', type=int, choices=range(10), default=png_chunks.DEFAULT_ZLIB_LEVEL,
+                             metavar='0-9', help="zlib level for compressed PNG text (default: %(default)s)")
+
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    strip = commands.add_parser('strip', parents=[common, write], help="remove metadata")
+    strip.add_argument('--categories', default=','.join(metadata_ops.DEFAULT_STRIP),
+                       help=f"comma separated metadata to remove from {', '.join(metadata_ops.STRIP_CATEGORIES)} "
+                            f"or 'all' (default: all but icc)")
+    strip.set_defaults(func=cmd_strip)
+
+    set_ = commands.add_parser('set', parents=[common, write, compression], help="set or remove metadata fields")
+    set_.add_argument('--field', action='append', metavar='KEY=VALUE',
+                      help="PNG text keyword or JPEG EXIF tag name to set, may be repeated")
+    set_.add_argument('--remove', action='append', metavar='KEY', help="field to remove, may be repeated")
+    set_.set_defaults(func=cmd_set)
+
+    copy = commands.add_parser('copy', parents=[common, write, compression], help="copy metadata fields from another image")
+    copy.add_argument('--from', dest='source', required=True, help="image to copy the fields from")
+    copy.add_argument('--key', action='append', help="only copy this field, may be repeated")
+    copy.set_defaults(func=cmd_copy)
+
+    recompress = commands.add_parser('recompress', parents=[common, write],
+                                     help="compress large PNG text chunks (zTXt/iTXt) to shrink files")
+    recompress.add_argument('--threshold', type=int, default=png_chunks.COMPRESS_THRESHOLD,
+                            help="compress values of at least this many bytes (default: %(default)s)")
+    recompress.add_argument('--level', type=int, choices=range(10), default=9, metavar='0-9',
+                            help="zlib compression level (default: %(default)s)")
+    recompress.set_defaults(func=cmd_recompress)
+
+    replace = commands.add_parser('replace', parents=[common, write, compression],
+                                  help="find and replace prompt text (UserComment, parameters, workflow nodes)")
+    replace.add_argument('--find', required=True, help="text to find")
+    replace.add_argument('--replace', required=True, help="replacement text, may be empty")
+    replace.add_argument('--regex', action='store_true',
+                         help="treat --find as a regular expression, --replace may use \\1 or \\g<name>")
+    replace.add_argument('-i', '--ignore-case', action='store_true', help="match regardless of case")
+    replace.add_argument('-n', '--dry-run', action='store_true',
+                         help="print a diff of every change instead of writing files")
+    replace.set_defaults(func=cmd_replace)
+
+    export = commands.add_parser('export', parents=[common], help="export metadata as JSON lines or CSV")
+    export.add_argument('-o', '--output', help="output file (default: standard output)")
+    export.add_argument('--format', choices=metadata_export.EXPORT_FORMATS,
+                        help="output format (default: csv for a .csv output file, else jsonl)")
+    export.add_argument('--index', default=metadata_index.DEFAULT_INDEX_PATH,
+                        help="metadata index shared with the viewer; unchanged files are exported"
+                             " from it and parsed files added (default: %(default)s)")
+    export.add_argument('--no-index', action='store_true', help="parse every file, leave the index alone")
+    export.set_defaults(func=cmd_export)
+
+    duplicates = commands.add_parser('duplicates', parents=[common],
+                                     help="list files with the same image content, whatever their metadata")
+    duplicates.add_argument('--perceptual', action='store_true',
+                            help="also group visually similar files by their difference hash (dHash)")
+    duplicates.add_argument('--distance', type=int, choices=range(65), metavar='0-64',
+                            help="largest dHash bit difference for similar files, implies --perceptual (default: 4)")
+    duplicates.add_argument('--index', default=fingerprint_index.DEFAULT_FINGERPRINT_PATH,
+                            help="fingerprint database, reused between runs (default: %(default)s)")
+    duplicates.set_defaults(func=cmd_duplicates)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    instrumentation.configure_from_env()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""Editable in-memory model of an image's metadata.
+
+A MetadataDocument wraps the parsed ImageMetadata of one file: its EXIF
+tags, PNG text chunks and the decoded ComfyUI prompt graph, indexed by
+node id. The viewer renders the editable prompt fields from the model and
+hands edits back with set_value(); saving only rewrites the fields that
+actually changed.
+"""
+import json
+import os
+
+import instrumentation
+import jpeg_segments
+import metadata_reader
+import png_chunks
+
+EDITABLE_FORMATS = ('PNG', 'JPEG')
+
+
+class Field:
+    """One editable value, identified by (kind, key)
+
+    kind is 'exif' for an EXIF tag, 'text' for a PNG text chunk or 'node'
+    for the prompt text of a node in the PNG 'prompt' workflow graph.
+    """
+
+    def __init__(self, kind, key, label, value):
+        self.kind = kind
+        self.key = key
+        self.label = label
+        self.original = value
+        self.value = value
+
+    @property
+    def id(self):
+        return (self.kind, self.key)
+
+    @property
+    def dirty(self):
+        return self.value != self.original
+
+    def __repr__(self):
+        return f"Field({self.kind!r}, {self.key!r}, dirty={self.dirty})"
+
+
+class MetadataDocument:
+    """Metadata of one image plus the edits made to it"""
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.path = meta.path
+        self.format = meta.format
+        self.exif = meta.exif
+        self.text = meta.text
+        self.workflow = meta.workflow()
+        # node id -> (node, input name or None for widgets_values[0])
+        self.prompt_nodes = {}
+        self.fields = {}
+        self._build_fields()
+
+    @classmethod
+    def load(cls, path):
+        return cls(metadata_reader.read_metadata(path))
+
+    def _build_fields(self):
+        if self.format == 'JPEG' and 'UserComment' in self.exif:
+            value = jpeg_segments.decode_user_comment(self.exif['UserComment'])
+            self._add_field('exif', 'UserComment', 'UserComment', value)
+        if self.format != 'PNG':
+            return
+        for node_id, node in (self.workflow or {}).items():
+            if not isinstance(node, dict) or node.get('class_type') not in metadata_reader.PROMPT_NODE_TYPES:
+                continue
+            if isinstance(node.get('inputs'), dict) and 'text' in node['inputs']:
+                self.prompt_nodes[node_id] = (node, 'text')
+                value = node['inputs']['text']
+            elif node.get('widgets_values'):
+                self.prompt_nodes[node_id] = (node, None)
+                value = node['widgets_values'][0]
+            else:
+                continue
+            if isinstance(value, str):
+                self._add_field('node', node_id, f"Node {node_id}", value)
+        if 'parameters' in self.text:
+            self._add_field('text', 'parameters', 'parameters', self.text['parameters'])
+
+    def _add_field(self, kind, key, label, value):
+        field = Field(kind, key, label, value)
+        self.fields[field.id] = field
+
+    def set_value(self, field_id, value):
+        self.fields[field_id].value = value
+
+    @property
+    def dirty(self):
+        return any(field.dirty for field in self.fields.values())
+
+    def dirty_fields(self):
+        return [field for field in self.fields.values() if field.dirty]
+
+    def is_current(self):
+        """Return False if the file changed on disk since it was read"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime_ns) == (self.meta.file_size, self.meta.mtime_ns)
+
+    def updates(self):
+        """Return the container level changes, text chunks or EXIF tags
+
+        The workflow graph is only serialized again when one of its nodes
+        was edited.
+        """
+        updates = {}
+        node_edits = {}
+        for field in self.dirty_fields():
+            if field.kind == 'node':
+                node_edits[field.key] = field.value
+            else:
+                updates[field.key] = field.value
+        if node_edits:
+            updates['prompt'] = self._workflow_json(node_edits)
+        return updates
+
+    def _workflow_json(self, node_edits):
+        # Apply the edits to the parsed graph only while serializing it, a
+        # deep copy of a multi-megabyte workflow would cost more
+        originals = {}
+        for node_id, value in node_edits.items():
+            node, name = self.prompt_nodes[node_id]
+            values = node['inputs'] if name else node['widgets_values']
+            key = name if name else 0
+            originals[node_id] = (values, key, values[key])
+            values[key] = value
+        try:
+            return json.dumps(self.workflow)
+        finally:
+            for values, key, value in originals.values():
+                values[key] = value
+
+    def save(self, target, fsync=False):
+        """Write the file with the edited fields to target, may be self.path
+
+        Returns the names of the fields written. Only PNG and JPEG files are
+        edited here, at the container level.
+        """
+        if self.format not in EDITABLE_FORMATS:
+            raise ValueError(f"Editing metadata is not supported for {self.format} files")
+        with instrumentation.stage('encode'):
+            updates = self.updates()
+        with instrumentation.stage('write', format=self.format):
+            if self.format == 'PNG':
+                png_chunks.write_text_chunks(self.path, target, updates, fsync=fsync)
+            else:
+                jpeg_segments.update_exif_fields(self.path, target, updates, fsync=fsync)
+        return sorted(updates)
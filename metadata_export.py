@@ -0,0 +1,112 @@
+"""Streaming export of metadata records as JSON lines or CSV.
+
+Records are parsed in the batch process pool and written out one at a time
+as they come back, so memory use does not grow with the number of files.
+Given a MetadataIndex, the records of files unchanged since they were indexed
+are taken from it instead, and the files parsed are added to it.
+"""
+import csv
+import itertools
+import json
+import os
+
+import batch
+import metadata_ops
+import sqlite_index
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+# CSV columns; nested values are written as JSON
+CSV_FIELDS = ('path', 'format', 'width', 'height', 'mode', 'file_size', 'mtime_ns',
+              'text_keys', 'exif', 'prompts')
+CSV_JSON_FIELDS = ('text_keys', 'exif', 'prompts')
+
+
+def format_for_path(path, default='jsonl'):
+    """Guess the export format from an output file name"""
+    if path and os.path.splitext(path)[1].lower() == '.csv':
+        return 'csv'
+    return default
+
+
+class JsonlWriter:
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, record):
+        self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+class CsvWriter:
+    def __init__(self, f):
+        self.writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, record):
+        row = dict(record)
+        for field in CSV_JSON_FIELDS:
+            row[field] = json.dumps(record.get(field), ensure_ascii=False)
+        self.writer.writerow(row)
+
+
+def make_writer(f, export_format):
+    """Return a record writer for an open text file, f should use newline=''"""
+    if export_format == 'csv':
+        return CsvWriter(f)
+    if export_format == 'jsonl':
+        return JsonlWriter(f)
+    raise ValueError(f"Unknown export format: {export_format}")
+
+
+def export_records(paths, f, export_format='jsonl', workers=None, chunksize=batch.DEFAULT_CHUNKSIZE,
+                   on_error=None, progress=None, mp_context=None, index=None):
+    """Parse paths in the process pool and stream their records to f
+
+    on_error(path, message) is called for files that could not be read and
+    progress(throughput) after every file. mp_context is handed to
+    batch.imap_chunked(). With a MetadataIndex, the records it holds for
+    unchanged files are written first, then the remaining files are parsed
+    and stored in the index. Returns the batch.Throughput.
+    """
+    writer = make_writer(f, export_format)
+    throughput = batch.Throughput()
+
+    def add(record):
+        writer.write(record)
+        throughput.add(record['file_size'])
+        if progress:
+            progress(throughput)
+
+    if index is not None:
+        paths = iter(paths)
+        stale = []
+        while True:
+            chunk = list(itertools.islice(paths, sqlite_index.QUERY_BATCH_SIZE))
+            if not chunk:
+                break
+            records = index.records(chunk)
+            for path in chunk:
+                if path in records:
+                    add(records[path])
+                else:
+                    stale.append(path)
+        paths = stale
+    parsed = []
+    items = ((path,) for path in paths)
+    for item, record, error in batch.imap_chunked(
+            metadata_ops.export_record, items, workers=workers, chunksize=chunksize, mp_context=mp_context):
+        if error:
+            if on_error:
+                on_error(item[0], error)
+            throughput.add(error=True)
+            if progress:
+                progress(throughput)
+            continue
+        add(record)
+        if index is not None:
+            parsed.append(record)
+            if len(parsed) >= sqlite_index.COMMIT_BATCH_SIZE:
+                index.store_records(parsed)
+                parsed = []
+    if parsed:
+        index.store_records(parsed)
+    return throughput
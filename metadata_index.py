@@ -0,0 +1,233 @@
+"""Persistent SQLite index of parsed image metadata.
+
+Rows are keyed by path and remember the file size and mtime they were parsed
+from, so reopening a folder only re-parses the files that changed since.
+The index backs the prompt search and the metadata export, which takes the
+records of unchanged files from here; the viewer itself shows metadata parsed
+from the file (see metadata_cache), since the index does not keep the text
+values it would need to render.
+"""
+import json
+import os
+import re
+import sqlite3
+
+import metadata_reader
+import sqlite_index
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.metadata_manager', 'index.sqlite3')
+
+# Larger search results are returned in index order instead of by rank
+RANK_LIMIT = 5000
+# Columns records() rebuilds an ImageMetadata.as_record() dict from
+RECORD_COLUMNS = ('size', 'mtime_ns', 'format', 'width', 'height', 'mode', 'exif', 'text_keys', 'prompts', 'error')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    format TEXT,
+    width INTEGER,
+    height INTEGER,
+    mode TEXT,
+    exif TEXT,
+    text_keys TEXT,
+    prompts TEXT,
+    prompt_text TEXT,
+    error TEXT
+);
+"""
+
+# External content FTS5 table over the prompt text, kept in sync by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE prompt_fts USING fts5(
+    prompt_text, content='files', content_rowid='id', prefix='2 3');
+CREATE TRIGGER files_fts_insert AFTER INSERT ON files BEGIN
+    INSERT INTO prompt_fts(rowid, prompt_text) VALUES (new.id, new.prompt_text);
+END;
+CREATE TRIGGER files_fts_delete AFTER DELETE ON files BEGIN
+    INSERT INTO prompt_fts(prompt_fts, rowid, prompt_text) VALUES ('delete', old.id, old.prompt_text);
+END;
+CREATE TRIGGER files_fts_update AFTER UPDATE ON files BEGIN
+    INSERT INTO prompt_fts(prompt_fts, rowid, prompt_text) VALUES ('delete', old.id, old.prompt_text);
+    INSERT INTO prompt_fts(rowid, prompt_text) VALUES (new.id, new.prompt_text);
+END;
+INSERT INTO prompt_fts(prompt_fts) VALUES ('rebuild');
+"""
+
+UPSERT = """
+INSERT INTO files (path, size, mtime_ns, format, width, height, mode, exif, text_keys, prompts, prompt_text, error)
+VALUES (:path, :size, :mtime_ns, :format, :width, :height, :mode, :exif, :text_keys, :prompts, :prompt_text, :error)
+ON CONFLICT(path) DO UPDATE SET
+    size = excluded.size, mtime_ns = excluded.mtime_ns, format = excluded.format,
+    width = excluded.width, height = excluded.height, mode = excluded.mode,
+    exif = excluded.exif, text_keys = excluded.text_keys, prompts = excluded.prompts,
+    prompt_text = excluded.prompt_text, error = excluded.error
+"""
+
+
+class MetadataIndex(sqlite_index.SQLiteIndex):
+    """SQLite backed cache of ImageMetadata records"""
+
+    TABLE = 'files'
+    SCHEMA = SCHEMA
+    UPSERT = UPSERT
+
+    def __init__(self, db_path=DEFAULT_INDEX_PATH):
+        super().__init__(db_path)
+        with self.lock, self.conn:
+            self.has_fts = self._ensure_fts()
+
+    def _ensure_fts(self):
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'prompt_fts'").fetchone()
+        if exists:
+            return True
+        try:
+            self.conn.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            # SQLite built without FTS5, search falls back to LIKE
+            print(f"Warning: Full-text search unavailable: {e}")
+            return False
+        return True
+
+    def refresh(self, paths, parse=metadata_reader.read_metadata):
+        """Re-parse the paths whose size or mtime changed and store the results
+
+        Returns the list of paths that were (re)parsed. Results are committed
+        in batches so readers are never locked out for long.
+        """
+        stale = self.stale_paths(paths)
+        rows = []
+        for path in stale:
+            try:
+                rows.append(self._record_row(parse(path).as_record()))
+            except Exception as e:
+                rows.append(self._error_row(path, e))
+            if len(rows) >= sqlite_index.COMMIT_BATCH_SIZE:
+                self._store_rows(rows)
+                rows = []
+        if rows:
+            self._store_rows(rows)
+        return stale
+
+    def records(self, paths):
+        """Return {path: record} for the paths indexed and unchanged on disk
+
+        A record equals ImageMetadata.as_record() of the file, so callers
+        can skip parsing it. Files that failed to parse are left out.
+        """
+        records = {}
+        for path, row in self.stored_rows(paths, RECORD_COLUMNS).items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if row['error'] is not None or (row['size'], row['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+                continue
+            records[path] = {
+                'path': path,
+                'format': row['format'],
+                'width': row['width'],
+                'height': row['height'],
+                'mode': row['mode'],
+                'file_size': row['size'],
+                'mtime_ns': row['mtime_ns'],
+                'exif': json.loads(row['exif']),
+                'text_keys': json.loads(row['text_keys']),
+                'prompts': json.loads(row['prompts']),
+            }
+        return records
+
+    def store_records(self, records):
+        """Store ImageMetadata.as_record() dicts parsed elsewhere"""
+        self._store_rows([self._record_row(record) for record in records])
+
+    def search(self, query, limit=None):
+        """Return the paths whose prompt text matches query, best match first
+
+        Words must all appear, "quoted text" matches a phrase and word*
+        matches a prefix. Unless the query ends with whitespace the last word
+        is treated as a prefix too, so results can follow live typing.
+        """
+        if self.has_fts:
+            match = fts_query(query)
+            if not match:
+                return []
+            sql = ("SELECT files.path FROM prompt_fts JOIN files ON files.id = prompt_fts.rowid"
+                   " WHERE prompt_fts MATCH ?")
+            params = [match]
+        else:
+            terms = [term.strip('"*') for term in _QUERY_TOKEN.findall(query)]
+            terms = [term for term in terms if term]
+            if not terms:
+                return []
+            sql = "SELECT path FROM files WHERE " + ' AND '.join(["prompt_text LIKE ? ESCAPE '\\'"] * len(terms))
+            params = ['%' + re.sub(r'([%_\\])', r'\\\1', term) + '%' for term in terms]
+        with self.lock:
+            try:
+                paths = [row[0] for row in self.conn.execute(sql, params)]
+                # Ranking costs a bm25() call per match. When a query matches
+                # most of the library the order means little, so only result
+                # sets of a reasonable size are ranked.
+                if self.has_fts and 1 < len(paths) <= RANK_LIMIT:
+                    paths = [row[0] for row in self.conn.execute(sql + " ORDER BY prompt_fts.rank", params)]
+            except sqlite3.OperationalError as e:
+                print(f"Warning: Search failed: {e}")
+                return []
+        return paths if limit is None else paths[:limit]
+
+    @staticmethod
+    def _record_row(record):
+        return {
+            'path': record['path'],
+            'size': record['file_size'],
+            'mtime_ns': record['mtime_ns'],
+            'format': record['format'],
+            'width': record['width'],
+            'height': record['height'],
+            'mode': record['mode'],
+            'exif': json.dumps(record['exif']),
+            'text_keys': json.dumps(record['text_keys']),
+            'prompts': json.dumps(record['prompts']),
+            'prompt_text': '\n\n'.join(prompt['text'] for prompt in record['prompts']),
+            'error': None,
+        }
+
+    @staticmethod
+    def _error_row(path, error):
+        try:
+            st = os.stat(path)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        except OSError:
+            size, mtime_ns = -1, -1
+        return {
+            'path': path, 'size': size, 'mtime_ns': mtime_ns, 'format': None, 'width': None,
+            'height': None, 'mode': None, 'exif': None, 'text_keys': None, 'prompts': None,
+            'prompt_text': None, 'error': str(error),
+        }
+
+
+_QUERY_TOKEN = re.compile(r'"[^"]*"?|[^\s"]+')
+
+
+def fts_query(text):
+    """Translate a user search string into an FTS5 MATCH expression
+
+    Every term is quoted so FTS5 operators in the input are taken literally.
+    """
+    tokens = _QUERY_TOKEN.findall(text)
+    terms = []
+    for i, token in enumerate(tokens):
+        if token.startswith('"'):
+            phrase = token.strip('"')
+            if phrase.strip():
+                terms.append('"' + phrase.replace('"', '""') + '"')
+            continue
+        prefix = token.endswith('*') or (i == len(tokens) - 1 and not text[-1:].isspace())
+        word = token.rstrip('*')
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
@@ -3,13 +3,53 @@ from tkinter import ttk, filedialog, messagebox, scrolledtext
 import os
 import sys
 from PIL import Image, ExifTags
-from PIL.ExifTags import TAGS
-import json
+import io
+import multiprocessing
+import collections
+import functools
+import re
 from pathlib import Path
 import threading
+import sqlite3
+import queue
+import time
+
+import batch
+import folder_watch
+import instrumentation
+import metadata_cache
+import metadata_document
+import metadata_export
+import metadata_index
+import metadata_ops
+import metadata_render
+import metadata_replace
+import thumbnail_cache
+from atomic_file import atomic_write
+from virtual_list import VirtualListbox
+
+# Paths handed from a folder scan to the UI at a time
+INGEST_BATCH_SIZE = 2000
+# How often the UI checks for metadata parsed in the background
+METADATA_POLL_MS = 20
+# How often the UI picks up changes from a watched folder
+WATCH_POLL_MS = 500
+# How often the UI picks up finished thumbnails
+THUMBNAIL_POLL_MS = 50
+# Thumbnails kept as Tk images for quick redraws while scrolling
+THUMBNAIL_MEMORY = 512
+# Start method of the batch pool workers. The UI runs several threads that
+# take locks (instrumentation, index, loaders), which fork() would copy in
+# whatever state they are in, so workers are started fresh.
+POOL_CONTEXT = multiprocessing.get_context('spawn')
+# Diff text shown by a find/replace preview, the counts cover everything
+REPLACE_PREVIEW_CHARS = 1024 * 1024
+# Stages shown in the timing readout, in pipeline order
+STATS_STAGES = ('open', 'decode_headers', 'json_parse', 'render', 'encode', 'write', 'fsync')
 
 class ImageMetadataManager:
     def __init__(self):
+        instrumentation.configure_from_env()
         self.window = tk.Tk()
         self.window.title("Image Metadata Manager")
         self.window.geometry("1400x800")
@@ -25,9 +65,46 @@ class ImageMetadataManager:
         self.main_frame = ttk.Frame(self.window, padding="20")
         self.main_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         
-        # Image list to store loaded images
-        self.image_list = []
+        # Loaded images, an insertion ordered dict used as a set so
+        # membership checks stay O(1) for very large folders
+        self.image_list = {}
+        # Paths currently shown in the listbox, in listbox order
+        self.visible_paths = []
         self.current_image = None
+        # Editable model of the displayed metadata, and the text marks
+        # delimiting its fields in the metadata text widget
+        self.current_document = None
+        self.field_marks = []
+        # Tag -> metadata_render.CollapsedValue for large values not yet expanded
+        self.collapsed_values = {}
+        
+        # Folder scans run on a background thread and hand over batches
+        # Scans share the queue, each ends its batches with a None sentinel
+        self.ingest_queue = queue.Queue()
+        self.ingest_scans = 0
+        
+        # Watched folder, changed files arrive in batches on watch_queue
+        self.folder_watcher = None
+        self.watch_queue = queue.Queue()
+        
+        # Persistent metadata index, survives restarts
+        try:
+            self.metadata_index = metadata_index.MetadataIndex()
+        except sqlite3.Error as e:
+            print(f"Warning: Metadata index disabled: {e}")
+            self.metadata_index = None
+        # Metadata is parsed off the UI thread and cached for quick browsing
+        self.metadata_loader = metadata_cache.MetadataLoader()
+        # Thumbnails of the rows on screen, generated in the background.
+        # Tk images of recently shown ones stay in memory, least recently
+        # used first, and files that cannot be thumbnailed are not retried.
+        self.thumbnail_loader = thumbnail_cache.ThumbnailLoader()
+        self.thumbnail_images = collections.OrderedDict()
+        self.thumbnail_failed = set()
+        # A single indexer thread works through newly added paths in order
+        self.index_queue = queue.Queue()
+        if self.metadata_index:
+            threading.Thread(target=self._index_worker, daemon=True).start()
         
         # Setup file drag & drop
         self.window.drop_target_register = lambda *args: None  # Dummy function
@@ -36,9 +113,8 @@ class ImageMetadataManager:
         
         # Create and configure widgets
         self.create_widgets()
-        
-        # Create and configure widgets
-        self.create_widgets()
+        self.window.after(METADATA_POLL_MS, self._poll_metadata)
+        self.window.after(THUMBNAIL_POLL_MS, self._poll_thumbnails)
         
         # Configure grid weights
         self.window.columnconfigure(0, weight=1)
@@ -53,24 +129,41 @@ class ImageMetadataManager:
         self.file_list_frame = ttk.LabelFrame(self.left_panel, text="Image Files", padding="10")
         self.file_list_frame.pack(fill=tk.BOTH, expand=True)
         
-        # Create listbox for files
-        self.file_listbox = tk.Listbox(self.file_list_frame, width=40, height=15, font=('Courier', 10))
+        # Prompt search box, filters the list as you type
+        self.search_var = tk.StringVar()
+        self.search_job = None
+        self.search_entry = ttk.Entry(self.file_list_frame, textvariable=self.search_var)
+        self.search_entry.pack(fill=tk.X, pady=(0, 5))
+        self.search_var.trace_add('write', self.on_search_changed)
+        
+        # Create listbox for files, only the visible rows are ever rendered,
+        # each with its thumbnail in front of the name
+        self.file_listbox = VirtualListbox(
+            self.file_list_frame,
+            lambda idx: os.path.basename(self.visible_paths[idx]),
+            get_image=self.thumbnail_image,
+            image_size=thumbnail_cache.THUMBNAIL_SIZE,
+            width=40, height=8, font=('Courier', 10)
+        )
         self.file_listbox.pack(fill=tk.BOTH, expand=True)
         self.file_listbox.bind('<<ListboxSelect>>', self.on_select_file)
-        
-        # Scrollbar for listbox
-        listbox_scrollbar = ttk.Scrollbar(self.file_list_frame, orient=tk.VERTICAL, command=self.file_listbox.yview)
-        listbox_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.file_listbox.configure(yscrollcommand=listbox_scrollbar.set)
+        self.file_listbox.bind('<<ListboxView>>', lambda event: self.request_thumbnails())
         
         # Buttons for file operations
         self.file_buttons_frame = ttk.Frame(self.left_panel)
         self.file_buttons_frame.pack(fill=tk.X, pady=(10, 0))
         
         ttk.Button(self.file_buttons_frame, text="Add Images", command=self.add_images).pack(side=tk.LEFT, padx=2)
+        ttk.Button(self.file_buttons_frame, text="Add Folder", command=self.add_folder).pack(side=tk.LEFT, padx=2)
+        self.watch_button_var = tk.StringVar(value="Watch Folder")
+        ttk.Button(self.file_buttons_frame, textvariable=self.watch_button_var, command=self.toggle_watch).pack(side=tk.LEFT, padx=2)
         ttk.Button(self.file_buttons_frame, text="Remove Selected", command=self.remove_selected).pack(side=tk.LEFT, padx=2)
         ttk.Button(self.file_buttons_frame, text="Clear All", command=self.clear_files).pack(side=tk.LEFT, padx=2)
         
+        # Status line below the file list
+        self.status_var = tk.StringVar(value="No images loaded")
+        ttk.Label(self.left_panel, textvariable=self.status_var).pack(fill=tk.X, pady=(5, 0))
+        
         # Create right panel for metadata
         self.right_panel = ttk.Frame(self.main_frame)
         self.right_panel.grid(row=0, column=1, sticky=(tk.W, tk.E, tk.N, tk.S))
@@ -98,7 +191,18 @@ class ImageMetadataManager:
         
         ttk.Button(self.metadata_buttons_frame, text="Save Changes", command=self.save_changes).pack(side=tk.LEFT, padx=2)
         ttk.Button(self.metadata_buttons_frame, text="Export Metadata", command=self.export_metadata).pack(side=tk.LEFT, padx=2)
+        ttk.Button(self.metadata_buttons_frame, text="Export All", command=self.export_all).pack(side=tk.LEFT, padx=2)
+        ttk.Button(self.metadata_buttons_frame, text="Find/Replace", command=self.find_replace).pack(side=tk.LEFT, padx=2)
+        ttk.Button(self.metadata_buttons_frame, text="Remove All Metadata", command=self.remove_all_metadata).pack(side=tk.LEFT, padx=2)
         ttk.Button(self.metadata_buttons_frame, text="Clear", command=self.clear_metadata).pack(side=tk.LEFT, padx=2)
+        ttk.Button(self.metadata_buttons_frame, text="Stats", command=self.show_stats).pack(side=tk.RIGHT, padx=2)
+        self.profile_var = tk.BooleanVar(value=instrumentation.stats.profiling)
+        ttk.Checkbutton(self.metadata_buttons_frame, text="Profile", variable=self.profile_var,
+                        command=self.toggle_profile).pack(side=tk.RIGHT, padx=2)
+        
+        # Timings of the last metadata load and save
+        self.stats_var = tk.StringVar(value="")
+        ttk.Label(self.right_panel, textvariable=self.stats_var, foreground='#555555').pack(fill=tk.X, pady=(5, 0))
         
         # Configure grid weights for panels
         self.main_frame.columnconfigure(1, weight=3)
@@ -118,10 +222,139 @@ class ImageMetadataManager:
     
     def add_image_paths(self, paths):
         """Add multiple image paths to the list"""
+        new_paths = []
         for path in paths:
             if path and path not in self.image_list:
-                self.image_list.append(path)
-                self.file_listbox.insert(tk.END, os.path.basename(path))
+                self.image_list[path] = None
+                new_paths.append(path)
+        # While a search is active new files show up with the next search
+        if new_paths and not self.search_var.get().strip():
+            self.visible_paths.extend(new_paths)
+            self.file_listbox.set_count(len(self.visible_paths))
+        self.update_status()
+        self.index_paths(new_paths)
+    
+    def add_folder(self):
+        """Add every image below a folder, scanning it in the background"""
+        folder = filedialog.askdirectory(title="Select Folder")
+        if folder:
+            self.scan_folder(folder)
+    
+    def scan_folder(self, folder):
+        self.ingest_scans += 1
+        threading.Thread(target=self._scan_folder, args=(folder,), daemon=True).start()
+        if self.ingest_scans == 1:
+            self.window.after(50, self._drain_ingest_queue)
+    
+    def toggle_watch(self):
+        """Start watching a folder for new images, or stop the current watch"""
+        if self.folder_watcher:
+            self.folder_watcher.stop()
+            self.folder_watcher = None
+            self.watch_button_var.set("Watch Folder")
+            self.update_status()
+            return
+        folder = filedialog.askdirectory(title="Select Folder to Watch")
+        if not folder:
+            return
+        # Load what is there now, the watcher reports everything after that
+        self.folder_watcher = folder_watch.FolderWatcher(folder, self.watch_queue.put)
+        self.folder_watcher.start()
+        self.scan_folder(folder)
+        self.watch_button_var.set("Stop Watching")
+        self.update_status()
+        self.window.after(WATCH_POLL_MS, self._poll_watch, self.folder_watcher)
+    
+    def _poll_watch(self, watcher):
+        if watcher is not self.folder_watcher:
+            return  # Stopped or replaced
+        changed = []
+        while True:
+            try:
+                changed.extend(self.watch_queue.get_nowait())
+            except queue.Empty:
+                break
+        if changed:
+            for path in changed:
+                self.metadata_loader.cache.invalidate(path)
+                self.thumbnail_images.pop(path, None)
+                self.thumbnail_failed.discard(path)
+            # Known files were modified, the rest is new
+            self.index_paths([path for path in changed if path in self.image_list])
+            self.add_image_paths(changed)
+            if self.current_image in changed:
+                self.display_metadata(self.current_image)
+        self.window.after(WATCH_POLL_MS, self._poll_watch, watcher)
+    
+    def _scan_folder(self, folder):
+        """Walk folder with os.scandir and queue the image paths in batches"""
+        batch_paths = []
+        try:
+            for path in batch.walk_images(folder):
+                batch_paths.append(path)
+                if len(batch_paths) >= INGEST_BATCH_SIZE:
+                    self.ingest_queue.put(batch_paths)
+                    batch_paths = []
+        finally:
+            self.ingest_queue.put(batch_paths)
+            self.ingest_queue.put(None)  # Scan finished
+    
+    def _drain_ingest_queue(self):
+        """Move queued folder scan results into the list without blocking the UI"""
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            try:
+                item = self.ingest_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.ingest_scans -= 1
+            elif item:
+                self.add_image_paths(item)
+        # Keep draining until every running scan has delivered its sentinel
+        if self.ingest_scans > 0:
+            self.window.after(50, self._drain_ingest_queue)
+    
+    def update_status(self):
+        status = f"{len(self.visible_paths)} of {len(self.image_list)} images shown"
+        if self.folder_watcher:
+            status += f", watching {os.path.basename(self.folder_watcher.directory)} ({self.folder_watcher.mode})"
+        self.status_var.set(status)
+    
+    def index_paths(self, paths):
+        """Queue paths for the background metadata indexer"""
+        if self.metadata_index and paths:
+            self.index_queue.put(list(paths))
+    
+    def _index_worker(self):
+        while True:
+            paths = self.index_queue.get()
+            try:
+                self.metadata_index.refresh(paths)
+            except Exception as e:
+                print(f"Warning: Could not update metadata index: {e}")
+    
+    def on_search_changed(self, *args):
+        """Debounce search box edits so typing stays responsive"""
+        if self.search_job:
+            self.window.after_cancel(self.search_job)
+        self.search_job = self.window.after(150, self.apply_search)
+    
+    def apply_search(self):
+        """Show only the loaded images whose prompt matches the search box"""
+        self.search_job = None
+        query = self.search_var.get()
+        if not query.strip() or not self.metadata_index:
+            self.visible_paths = list(self.image_list)
+        else:
+            self.visible_paths = [path for path in self.metadata_index.search(query) if path in self.image_list]
+        self.file_listbox.selection_clear()
+        self.file_listbox.set_count(len(self.visible_paths))
+        if self.current_image in self.visible_paths:
+            idx = self.visible_paths.index(self.current_image)
+            self.file_listbox.selection_set(idx)
+            self.file_listbox.see(idx)
+        self.update_status()
     
     def on_drag(self, event):
         """Handle file drag"""
@@ -147,15 +380,21 @@ class ImageMetadataManager:
         selection = self.file_listbox.curselection()
         if selection:
             idx = selection[0]
-            self.file_listbox.delete(idx)
-            self.image_list.pop(idx)
-            if self.current_image == self.image_list[idx]:
+            path = self.visible_paths.pop(idx)
+            del self.image_list[path]
+            self.file_listbox.selection_clear()
+            self.file_listbox.set_count(len(self.visible_paths))
+            self.update_status()
+            if self.current_image == path:
                 self.current_image = None
                 self.clear_metadata()
                 
     def clear_files(self):
-        self.file_listbox.delete(0, tk.END)
         self.image_list.clear()
+        self.visible_paths.clear()
+        self.file_listbox.selection_clear()
+        self.file_listbox.set_count(0)
+        self.update_status()
         self.current_image = None
         self.clear_metadata()
         
@@ -163,287 +402,202 @@ class ImageMetadataManager:
         selection = self.file_listbox.curselection()
         if selection:
             idx = selection[0]
-            self.current_image = self.image_list[idx]
-            self.display_metadata(self.current_image)
+            self.current_image = self.visible_paths[idx]
+            # Warm the cache with the neighbours so browsing stays instant
+            n = metadata_cache.DEFAULT_PREFETCH
+            neighbours = self.visible_paths[idx + 1:idx + 1 + n] + self.visible_paths[max(0, idx - n):idx]
+            self.display_metadata(self.current_image, neighbours)
             
-    def display_metadata(self, image_path):
+    def thumbnail_image(self, idx):
+        """The Tk image of the thumbnail of a list row, None until it is loaded"""
+        path = self.visible_paths[idx]
+        image = self.thumbnail_images.get(path)
+        if image is not None:
+            self.thumbnail_images.move_to_end(path)
+        return image
+    
+    def request_thumbnails(self):
+        """Queue the thumbnails of the rows in view, drawing the cached ones"""
+        first, end = self.file_listbox.visible_range()
+        paths = self.visible_paths[first:end]
+        missing = [path for path in paths if path not in self.thumbnail_images and path not in self.thumbnail_failed]
+        ready = self.thumbnail_loader.request(missing)
+        for path, thumbnail in ready.items():
+            self._load_thumbnail(path, thumbnail)
+        if ready:
+            self.file_listbox.redraw()
+    
+    def _load_thumbnail(self, path, thumbnail):
         try:
-            # Close any existing image to ensure fresh read
-            Image.open(image_path).close()
-            
-            # Open the image again to read metadata
-            with Image.open(image_path) as img:
-                self.metadata_text.delete(1.0, tk.END)
-                self.metadata_text.insert(tk.END, f"File: {os.path.basename(image_path)}\n")
-                self.metadata_text.insert(tk.END, f"Size: {img.size}\n")
-                self.metadata_text.insert(tk.END, f"Format: {img.format}\n")
-                self.metadata_text.insert(tk.END, f"Mode: {img.mode}\n\n")
-
-                prompt_found = False
-
-                # JPEG: look for UserComment in EXIF
-                if img.format in ["JPEG", "JPG"]:
-                    exif_data = img._getexif()
-                    if exif_data:
-                        self.metadata_text.insert(tk.END, "EXIF Data:\n")
-                        self.metadata_text.insert(tk.END, "-" * 40 + "\n")
-                        for tag_id, value in exif_data.items():
-                            tag = TAGS.get(tag_id, tag_id)
-                            if tag == "UserComment":
-                                prompt_found = True
-                                # Handle bytes and string formats
-                                if isinstance(value, bytes):
-                                    try:
-                                        value = value.decode('utf-8')
-                                    except:
-                                        try:
-                                            value = value.decode('ascii')
-                                        except:
-                                            value = str(value)
-                                self.metadata_text.insert(tk.END, f"PROMPT (UserComment):\n{value}\n\n")
-                            self.metadata_text.insert(tk.END, f"{tag}: {value}\n")
-                    else:
-                        self.metadata_text.insert(tk.END, "No EXIF data found\n")
-
-                # PNG: look for parameters (prompt)
-                elif img.format == "PNG":
-                    pnginfo = img.text if hasattr(img, 'text') else img.info
-                    if pnginfo and len(pnginfo) > 0:
-                        self.metadata_text.insert(tk.END, "PNG Metadata:\n")
-                        self.metadata_text.insert(tk.END, "-" * 40 + "\n")
-                        
-                        # First try to parse workflow and prompt data
-                        try:
-                            if "prompt" in pnginfo:
-                                workflow_data = json.loads(pnginfo["prompt"])
-                                prompt_found = True
-                                
-                                # Extract positive prompts from nodes
-                                for node_id, node in workflow_data.items():
-                                    if node.get("class_type") in ["CLIPTextEncode", "PromptSchedule"]:
-                                        if "inputs" in node and "text" in node["inputs"]:
-                                            self.metadata_text.insert(tk.END, f"PROMPT (Node {node_id}):\n")
-                                            self.metadata_text.insert(tk.END, f"{node['inputs']['text']}\n\n")
-                                        elif "widgets_values" in node and node["widgets_values"]:
-                                            self.metadata_text.insert(tk.END, f"PROMPT (Node {node_id}):\n")
-                                            self.metadata_text.insert(tk.END, f"{node['widgets_values'][0]}\n\n")
-                            
-                            # Look for traditional parameters
-                            if "parameters" in pnginfo:
-                                prompt_found = True
-                                self.metadata_text.insert(tk.END, "PROMPT (parameters):\n")
-                                self.metadata_text.insert(tk.END, f"{pnginfo['parameters']}\n\n")
-                        except json.JSONDecodeError:
-                            pass
-                        
-                        # Then display all metadata
-                        self.metadata_text.insert(tk.END, "All Metadata:\n")
-                        self.metadata_text.insert(tk.END, "-" * 40 + "\n")
-                        for k, v in pnginfo.items():
-                            # Try to format JSON data nicely
-                            try:
-                                if isinstance(v, str) and (v.startswith('{') or v.startswith('[')):
-                                    parsed_v = json.loads(v)
-                                    v = json.dumps(parsed_v, indent=2)
-                            except json.JSONDecodeError:
-                                pass
-                            self.metadata_text.insert(tk.END, f"{k}:\n{v}\n\n")
-                    else:
-                        self.metadata_text.insert(tk.END, "No PNG metadata found\n")
-
-                # TIFF/BMP/GIF: standard metadata
-                else:
-                    exif_data = img.info.get('exif')
-                    if exif_data:
-                        self.metadata_text.insert(tk.END, "EXIF Data:\n")
-                        self.metadata_text.insert(tk.END, "-" * 40 + "\n")
-                        self.metadata_text.insert(tk.END, str(exif_data) + "\n")
-                    else:
-                        self.metadata_text.insert(tk.END, "No metadata found\n")
+            self.thumbnail_images[path] = tk.PhotoImage(file=thumbnail)
+        except tk.TclError as e:
+            print(f"Warning: Could not load thumbnail of {path}: {e}")
+            self.thumbnail_failed.add(path)
+            return
+        while len(self.thumbnail_images) > THUMBNAIL_MEMORY:
+            self.thumbnail_images.popitem(last=False)
+    
+    def _poll_thumbnails(self):
+        finished = self.thumbnail_loader.poll()
+        for path, thumbnail, error in finished:
+            if error:
+                self.thumbnail_failed.add(path)
+            else:
+                self._load_thumbnail(path, thumbnail)
+        if finished:
+            self.file_listbox.redraw()
+        self.window.after(THUMBNAIL_POLL_MS, self._poll_thumbnails)
+    
+    def display_metadata(self, image_path, prefetch=()):
+        """Show the metadata of image_path, parsing it in the background if needed"""
+        meta = self.metadata_loader.request(image_path, prefetch)
+        if meta is not None:
+            self.show_metadata(meta)
+        else:
+            self.clear_metadata()
+            self.metadata_text.insert(tk.END, f"Loading metadata for {os.path.basename(image_path)}...\n")
+    
+    def _poll_metadata(self):
+        result = self.metadata_loader.poll()
+        if result and result[0] == self.current_image:
+            path, meta, error, timings = result
+            if error:
+                self.clear_metadata()
+                self.metadata_text.insert(tk.END, f"Error reading metadata: {error}")
+                self.update_stats(timings)
+            else:
+                self.show_metadata(meta, timings)
+        self.window.after(METADATA_POLL_MS, self._poll_metadata)
+    
+    def show_metadata(self, meta, timings=None):
+        """Render meta into the text box
 
-                if not prompt_found:
-                    self.metadata_text.insert(tk.END, "\nNo prompt found in metadata.\n")
-                    
+        timings holds the stages of the background load that produced
+        meta; a file served from the cache was not read, so it has none.
+        """
+        try:
+            self.clear_metadata()
+            document = metadata_document.MetadataDocument(meta)
+            self.current_document = document
+            with instrumentation.capture() as rendered_in, instrumentation.stage('render', path=meta.path):
+                rendered = metadata_render.render(document)
+                # The whole text goes in with a single insert
+                self.metadata_text.insert('1.0', *rendered.insert_args())
+            for field_id, head, tail in rendered.fields:
+                self.mark_field(field_id, head, tail)
+            self.collapsed_values = rendered.collapsed
+            for tag in rendered.collapsed:
+                self.metadata_text.tag_configure(tag, foreground='#0b5cad', underline=True)
+                self.metadata_text.tag_bind(tag, '<Button-1>', lambda event, tag=tag: self.expand_value(tag))
+                self.metadata_text.tag_bind(tag, '<Enter>', lambda event: self.metadata_text.configure(cursor='hand2'))
+                self.metadata_text.tag_bind(tag, '<Leave>', lambda event: self.metadata_text.configure(cursor='xterm'))
+            self.update_stats({**(timings or {}), **rendered_in})
         except Exception as e:
-            self.metadata_text.delete(1.0, tk.END)
+            self.clear_metadata()
             self.metadata_text.insert(tk.END, f"Error reading metadata: {str(e)}")
-            
+    
+    def mark_field(self, field_id, head, tail):
+        """Delimit an editable field with a pair of text marks
+        
+        The start mark has left gravity and the end mark right gravity, so
+        text typed anywhere inside the value, including at either edge,
+        stays between them. The helper tags placed by the renderer are
+        dropped once the marks are set.
+        """
+        n = len(self.field_marks)
+        start, end = f"field{n}.start", f"field{n}.end"
+        self.metadata_text.mark_set(start, self.metadata_text.tag_ranges(head)[1])
+        self.metadata_text.mark_gravity(start, tk.LEFT)
+        self.metadata_text.mark_set(end, self.metadata_text.tag_ranges(tail)[0])
+        self.metadata_text.mark_gravity(end, tk.RIGHT)
+        self.metadata_text.tag_delete(head, tail)
+        self.field_marks.append((field_id, start, end))
+    
+    def expand_value(self, tag):
+        """Replace a collapsed value's link with its next page of text"""
+        value = self.collapsed_values.get(tag)
+        ranges = self.metadata_text.tag_ranges(tag)
+        if value is None or not ranges:
+            return 'break'
+        start = self.metadata_text.index(ranges[0])
+        page = value.next_page()
+        self.metadata_text.delete(ranges[0], ranges[1])
+        if value.finished:
+            self.metadata_text.insert(start, page)
+            self.metadata_text.configure(cursor='xterm')
+        else:
+            self.metadata_text.insert(start, page, (), value.more(), (tag,))
+        return 'break'
+    
+    def sync_fields(self):
+        """Copy the text between each field's marks back into the document"""
+        for field_id, start, end in self.field_marks:
+            self.current_document.set_value(field_id, self.metadata_text.get(start, end))
+    
     def save_changes(self):
         if not self.current_image:
             messagebox.showwarning("Warning", "Please select an image first")
             return
+        document = self.current_document
+        if document is None or document.path != self.current_image:
+            messagebox.showwarning("Warning", "Metadata is still loading, please try again")
+            return
+        if not document.is_current():
+            messagebox.showwarning("Warning", "The file changed on disk, please select it again to reload it")
+            return
         
         try:
-            with Image.open(self.current_image) as img:
-                # Create a new image with the same mode and size
-                new_image = img.copy()
-                
-                # Get metadata text and parse it
-                metadata_text = self.metadata_text.get(1.0, tk.END)
-                lines = metadata_text.split('\n')
-                
-                # For PNG files
-                if img.format == 'PNG':
-                    # Create a new PngInfo object
-                    from PIL.PngImagePlugin import PngInfo
-                    metadata = PngInfo()
-                    
-                    # First check the text attribute, then fall back to info
-                    source_metadata = img.text if hasattr(img, 'text') and img.text else img.info
-                    
-                    # Copy all existing metadata
-                    for k, v in source_metadata.items():
-                        if k != 'parameters':  # We'll handle this separately
-                            try:
-                                metadata.add_text(str(k), str(v))
-                            except Exception as e:
-                                print(f"Warning: Could not add metadata {k}: {e}")
-                    
-                    # Get the entire metadata text for parameters
-                    current_text = ""
-                    capture_next = False
-                    for line in lines:
-                        if "PROMPT (parameters):" in line or "parameters:" in line:
-                            capture_next = True
-                            continue
-                        elif capture_next and line.strip():
-                            if not line.startswith("-"):
-                                current_text = line.strip()
-                                break
-                    
-                    if current_text:
-                        print(f"Setting new parameters: {current_text}")  # Debug print
-                        metadata.add_text("parameters", current_text)
-                    
-                    # Make sure we're using the metadata when saving
-                    new_image = img.copy()
-                    new_image.info = {}
+            self.sync_fields()
+            image_format = document.format
+            
+            # Ask user where to save the modified image
+            save_path = filedialog.asksaveasfilename(
+                initialfile=os.path.basename(self.current_image),
+                defaultextension=f".{image_format.lower()}",
+                filetypes=[
+                    (f"{image_format} files", f"*.{image_format.lower()}"),
+                    ("All files", "*.*")
+                ]
+            )
+            
+            if save_path:
+                with instrumentation.capture() as timings:
+                    if image_format in metadata_document.EDITABLE_FORMATS:
+                        # Only the edited fields are written; PNG image chunks
+                        # and JPEG scan data are copied byte for byte
+                        written = document.save(save_path)
+                    else:
+                        # Save other formats
+                        with instrumentation.stage('open'), Image.open(self.current_image) as img:
+                            new_image = img.copy()
+                        with instrumentation.stage('write', format=image_format):
+                            new_image.save(save_path, format=image_format)
+                        new_image.close()
+                        written = []
+                instrumentation.event('save', path=save_path, fields=written)
+                self.update_stats(timings)
                 
-                elif img.format in ['JPEG', 'JPG']:
-                    # Parse metadata text for JPEG
-                    in_usercomment_section = False
-                    usercomment_lines = []
-                    
-                    for line in lines:
-                        if "PROMPT (UserComment):" in line:
-                            in_usercomment_section = True
-                            continue
-                        elif in_usercomment_section and line.strip() and not line.startswith("-"):
-                            usercomment_lines.append(line.strip())
-                        elif in_usercomment_section and not line.strip():
-                            in_usercomment_section = False
-                    
-                    if usercomment_lines:
-                        prompt = "\n".join(usercomment_lines)
-                        # Get existing EXIF or create new
-                        exif_dict = new_image.info.get('exif', {})
-                        if not exif_dict:
-                            exif_dict = {}
-                        
-                        # Find UserComment tag ID
-                        user_comment_tag = None
-                        for tag_id, tag_name in TAGS.items():
-                            if tag_name == 'UserComment':
-                                user_comment_tag = tag_id
-                                break
-                        
-                        if user_comment_tag:
-                            exif_dict[user_comment_tag] = prompt.encode('utf-8')
-                            new_image.info['exif'] = exif_dict
+                # Update the list if it's a new file
+                if save_path not in self.image_list:
+                    self.add_image_paths([save_path])
+                else:
+                    self.index_paths([save_path])
                 
-                # Ask user where to save the modified image
-                save_path = filedialog.asksaveasfilename(
-                    initialfile=os.path.basename(self.current_image),
-                    defaultextension=f".{img.format.lower()}",
-                    filetypes=[
-                        (f"{img.format} files", f"*.{img.format.lower()}"),
-                        ("All files", "*.*")
-                    ]
-                )
+                # Update current image and display
+                self.current_image = save_path
                 
-                if save_path:
-                    if img.format == 'PNG':
-                        # Parse the current text to find any changes
-                        sections = {}
-                        current_section = None
-                        current_content = []
-                        
-                        for line in lines:
-                            if line.strip().endswith(':'):
-                                if current_section and current_content:
-                                    sections[current_section] = '\n'.join(current_content).strip()
-                                current_section = line.strip()[:-1]
-                                current_content = []
-                            elif line.strip() and not line.startswith('-' * 10):
-                                if current_section:
-                                    current_content.append(line.strip())
-                        
-                        if current_section and current_content:
-                            sections[current_section] = '\n'.join(current_content).strip()
-                        
-                        # Create new PngInfo object
-                        new_metadata = PngInfo()
-                        
-                        # First, preserve original workflow data if it exists
-                        if 'prompt' in img.info:
-                            try:
-                                workflow = json.loads(img.info['prompt'])
-                                # Update workflow with any changes from sections
-                                for section, content in sections.items():
-                                    if section.startswith('PROMPT (Node '):
-                                        node_id = section.split('Node ')[1].split(')')[0]
-                                        if node_id in workflow:
-                                            if 'inputs' in workflow[node_id] and 'text' in workflow[node_id]['inputs']:
-                                                workflow[node_id]['inputs']['text'] = content
-                                            elif 'widgets_values' in workflow[node_id]:
-                                                workflow[node_id]['widgets_values'][0] = content
-                                new_metadata.add_text('prompt', json.dumps(workflow))
-                            except json.JSONDecodeError:
-                                # If workflow parse failed, preserve original
-                                new_metadata.add_text('prompt', img.info['prompt'])
-                        
-                        # Add all other metadata
-                        for key, value in img.info.items():
-                            if key != 'prompt':  # Skip prompt as we handled it above
-                                try:
-                                    new_metadata.add_text(str(key), str(value))
-                                except Exception as e:
-                                    print(f"Warning: Could not preserve metadata {key}: {e}")
-                        
-                        # Clear the image info and save with new metadata
-                        new_image.info = {}
-                        new_image.save(save_path, format='PNG', pnginfo=new_metadata, optimize=False)
-                        print(f"Saved image with metadata: {new_metadata.text if hasattr(new_metadata, 'text') else new_metadata}")
-                    else:
-                        # Save other formats
-                        new_image.save(save_path, format=img.format)
-                    
-                    # Force close all images
-                    new_image.close()
-                    img.close()
-                    
-                    # Force reload the image to verify metadata
-                    with Image.open(save_path) as verify_img:
-                        print(f"Verified metadata after save: {verify_img.info}")  # Debug print
-                    
-                    # Update the list if it's a new file
-                    if save_path not in self.image_list:
-                        self.image_list.append(save_path)
-                        self.file_listbox.insert(tk.END, os.path.basename(save_path))
-                    
-                    # Update current image and display
-                    self.current_image = save_path
-                    
-                    # Select the new file in the listbox
-                    idx = self.image_list.index(save_path)
-                    self.file_listbox.selection_clear(0, tk.END)
+                # Select the new file in the listbox
+                self.file_listbox.selection_clear()
+                if save_path in self.visible_paths:
+                    idx = self.visible_paths.index(save_path)
                     self.file_listbox.selection_set(idx)
                     self.file_listbox.see(idx)
-                    
-                    # Wait a moment to ensure file is written
-                    self.window.after(100, lambda: self.display_metadata(save_path))
-                    
-                    messagebox.showinfo("Success", "Image saved with updated metadata")
+                
+                # Wait a moment to ensure file is written
+                self.metadata_loader.cache.invalidate(save_path)
+                self.window.after(100, lambda: self.display_metadata(save_path))
+                
+                messagebox.showinfo("Success", "Image saved with updated metadata")
                     
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save changes: {str(e)}")
@@ -467,11 +621,279 @@ class ImageMetadataManager:
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to export metadata: {str(e)}")
         
+    def export_all(self):
+        """Export structured metadata of every loaded image as JSON lines or CSV"""
+        if not self.image_list:
+            messagebox.showwarning("Warning", "Please add some images first")
+            return
+        
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".jsonl",
+            filetypes=[("JSON Lines", "*.jsonl"), ("CSV files", "*.csv"), ("All files", "*.*")]
+        )
+        
+        if file_path:
+            # The export runs in the background and reports back through state
+            state = {'paths': list(self.image_list), 'done': 0, 'errors': 0, 'result': None}
+            threading.Thread(target=self._export_all, args=(file_path, state), daemon=True).start()
+            self.window.after(200, self._poll_export, state)
+    
+    def _export_all(self, file_path, state):
+        def progress(throughput):
+            state['done'] = throughput.files
+            state['errors'] = throughput.errors
+        
+        try:
+            export_format = metadata_export.format_for_path(file_path)
+            with atomic_write(file_path) as raw:
+                f = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+                throughput = metadata_export.export_records(
+                    state['paths'], f, export_format, progress=progress,
+                    on_error=lambda path, error: print(f"Warning: Could not export {path}: {error}"),
+                    mp_context=POOL_CONTEXT, index=self.metadata_index)
+                f.flush()
+                f.detach()
+            state['result'] = throughput.summary()
+        except Exception as e:
+            state['result'] = e
+    
+    def _poll_export(self, state):
+        result = state['result']
+        if result is None:
+            self.status_var.set(f"Exporting metadata: {state['done']} of {len(state['paths'])} images")
+            self.window.after(200, self._poll_export, state)
+            return
+        self.update_status()
+        if isinstance(result, Exception):
+            messagebox.showerror("Error", f"Failed to export metadata: {str(result)}")
+        else:
+            messagebox.showinfo("Success", f"Metadata exported: {result}")
+    
+    def remove_all_metadata(self):
+        """Strip metadata from every loaded image, in place or into a folder"""
+        if not self.image_list:
+            messagebox.showwarning("Warning", "Please add some images first")
+            return
+        
+        overwrite = messagebox.askyesnocancel(
+            "Remove All Metadata",
+            "Overwrite the original files?\n\n"
+            "Yes strips the metadata in place, No writes clean copies to a folder of your choice."
+        )
+        if overwrite is None:
+            return
+        paths = list(self.image_list)
+        if overwrite:
+            targets = paths
+        else:
+            output = filedialog.askdirectory(title="Select Output Folder")
+            if not output:
+                return
+            # Keep the folder layout below the common parent so names cannot clash
+            try:
+                base = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+            except ValueError:
+                base = None
+            targets = [os.path.join(output, os.path.relpath(os.path.abspath(path), base) if base
+                                    else os.path.basename(path)) for path in paths]
+        
+        # Runs in the background like export_all(), reporting through state
+        state = {'paths': paths, 'targets': targets, 'done': 0, 'errors': 0, 'result': None}
+        threading.Thread(target=self._remove_all_metadata, args=(state,), daemon=True).start()
+        self.window.after(200, self._poll_remove_all, state)
+    
+    def _remove_all_metadata(self, state):
+        try:
+            throughput = batch.Throughput()
+            items = zip(state['paths'], state['targets'])
+            # PNG chunks and JPEG segments are dropped without re-encoding
+            results = batch.imap_chunked(metadata_ops.strip_metadata, items, mp_context=POOL_CONTEXT)
+            for item, result, error in results:
+                if error:
+                    print(f"Warning: Could not remove metadata from {item[0]}: {error}")
+                throughput.add(result, error=bool(error))
+                state['done'] = throughput.files
+                state['errors'] = throughput.errors
+            # One sync for the whole run instead of an fsync per file
+            batch.sync_filesystems()
+            state['result'] = throughput.summary()
+        except Exception as e:
+            state['result'] = e
+    
+    def _poll_remove_all(self, state):
+        result = state['result']
+        if result is None:
+            self.status_var.set(f"Removing metadata: {state['done']} of {len(state['paths'])} images")
+            self.window.after(200, self._poll_remove_all, state)
+            return
+        self.update_status()
+        for target in state['targets']:
+            self.metadata_loader.cache.invalidate(target)
+        if state['targets'] is state['paths']:
+            self.index_paths(state['paths'])
+            if self.current_image:
+                self.display_metadata(self.current_image)
+        if isinstance(result, Exception):
+            messagebox.showerror("Error", f"Failed to remove metadata: {str(result)}")
+        else:
+            message = f"Metadata removed: {result}"
+            if state['errors']:
+                message += ("\n\nFiles that could not be processed were left unchanged; "
+                            "only PNG and JPEG files can be stripped.")
+            messagebox.showinfo("Success", message)
+    
+    def find_replace(self):
+        """Open the dialog for replacing prompt text in every loaded image"""
+        if not self.image_list:
+            messagebox.showwarning("Warning", "Please add some images first")
+            return
+        dialog = tk.Toplevel(self.window)
+        dialog.title("Find and Replace in Prompts")
+        dialog.transient(self.window)
+        form = ttk.Frame(dialog, padding="10")
+        form.pack(fill=tk.BOTH, expand=True)
+        form.columnconfigure(1, weight=1)
+        form.rowconfigure(4, weight=1)
+        
+        find_var = tk.StringVar()
+        replace_var = tk.StringVar()
+        regex_var = tk.BooleanVar(value=False)
+        ignore_case_var = tk.BooleanVar(value=False)
+        ttk.Label(form, text="Find:").grid(row=0, column=0, sticky=tk.W)
+        ttk.Entry(form, textvariable=find_var, width=60).grid(row=0, column=1, sticky=(tk.W, tk.E), pady=2)
+        ttk.Label(form, text="Replace:").grid(row=1, column=0, sticky=tk.W)
+        ttk.Entry(form, textvariable=replace_var, width=60).grid(row=1, column=1, sticky=(tk.W, tk.E), pady=2)
+        options = ttk.Frame(form)
+        options.grid(row=2, column=1, sticky=tk.W)
+        ttk.Checkbutton(options, text="Regular expression", variable=regex_var).pack(side=tk.LEFT)
+        ttk.Checkbutton(options, text="Ignore case", variable=ignore_case_var).pack(side=tk.LEFT, padx=(10, 0))
+        
+        output = scrolledtext.ScrolledText(form, wrap=tk.NONE, width=100, height=25, font=('Courier', 10))
+        
+        def start(dry_run):
+            try:
+                replacement = metadata_replace.Replacement(
+                    find_var.get(), replace_var.get(), regex=regex_var.get(), ignore_case=ignore_case_var.get())
+            except (ValueError, re.error) as e:
+                messagebox.showerror("Error", f"Invalid search: {str(e)}", parent=dialog)
+                return
+            paths = list(self.image_list)
+            if not dry_run and not messagebox.askyesno(
+                    "Replace All", f"Rewrite the matching files among {len(paths)} images in place?", parent=dialog):
+                return
+            output.delete(1.0, tk.END)
+            state = {'paths': paths, 'dry_run': dry_run, 'done': 0, 'errors': 0, 'files': 0,
+                     'replacements': 0, 'changed': [], 'diffs': [], 'shown': 0, 'truncated': False, 'result': None}
+            threading.Thread(target=self._replace_all, args=(replacement, state), daemon=True).start()
+            self.window.after(200, self._poll_replace, state, output)
+        
+        buttons = ttk.Frame(form)
+        buttons.grid(row=3, column=1, sticky=tk.W, pady=(5, 5))
+        ttk.Button(buttons, text="Preview", command=lambda: start(True)).pack(side=tk.LEFT, padx=2)
+        ttk.Button(buttons, text="Replace All", command=lambda: start(False)).pack(side=tk.LEFT, padx=2)
+        output.grid(row=4, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S))
+    
+    def _replace_all(self, replacement, state):
+        try:
+            throughput = batch.Throughput()
+            func = functools.partial(metadata_replace.replace_in_file, replacement=replacement,
+                                     dry_run=state['dry_run'])
+            preview_chars = 0
+            items = ((path, path) for path in state['paths'])
+            for item, result, error in batch.imap_chunked(func, items, mp_context=POOL_CONTEXT):
+                if error:
+                    print(f"Warning: Could not replace in {item[0]}: {error}")
+                    throughput.add(error=True)
+                else:
+                    size, changes = result
+                    throughput.add(size)
+                    if changes:
+                        state['files'] += 1
+                        state['replacements'] += sum(change.count for change in changes)
+                        state['changed'].append(item[0])
+                    for change in changes:
+                        if change.diff and preview_chars < REPLACE_PREVIEW_CHARS:
+                            preview_chars += len(change.diff)
+                            state['diffs'].append(change.diff)
+                        elif change.diff:
+                            state['truncated'] = True
+                state['done'] = throughput.files
+                state['errors'] = throughput.errors
+            if not state['dry_run']:
+                batch.sync_filesystems()
+            state['result'] = throughput.summary()
+        except Exception as e:
+            state['result'] = e
+    
+    def _poll_replace(self, state, output):
+        # Diffs are only ever appended by the worker, show the new ones
+        diffs = state['diffs'][state['shown']:]
+        state['shown'] += len(diffs)
+        if diffs and output.winfo_exists():
+            output.insert(tk.END, '\n'.join(diffs) + '\n')
+        result = state['result']
+        verb = "would change" if state['dry_run'] else "changed"
+        counts = f"{state['replacements']} replacement(s), {state['files']} file(s) {verb}"
+        if result is None:
+            self.status_var.set(f"Replacing: {state['done']} of {len(state['paths'])} images, {counts}")
+            self.window.after(200, self._poll_replace, state, output)
+            return
+        self.update_status()
+        if not state['dry_run']:
+            for path in state['changed']:
+                self.metadata_loader.cache.invalidate(path)
+            self.index_paths(state['changed'])
+            if self.current_image in state['changed']:
+                self.display_metadata(self.current_image)
+        if output.winfo_exists():
+            if state['truncated']:
+                output.insert(tk.END, "\n[Preview truncated, the counts below cover every file]\n")
+            output.insert(tk.END, f"\n{counts}\n{result}\n")
+        if isinstance(result, Exception):
+            messagebox.showerror("Error", f"Find and replace failed: {str(result)}")
+    
+    def update_stats(self, timings):
+        """Show the stage timings of the last load or save below the metadata buttons
+
+        timings comes from instrumentation.capture() around that load or
+        save, so work on other threads never shows up here.
+        """
+        parts = [f"{name} {timings[name]:.1f} ms" for name in STATS_STAGES if name in timings]
+        self.stats_var.set("Last: " + ", ".join(parts) if parts else "")
+    
+    def show_stats(self):
+        lines = instrumentation.stats.summary_lines()
+        messagebox.showinfo("Stats", "\n".join(lines) if lines else "Nothing measured yet")
+    
+    def toggle_profile(self):
+        """Start or stop profiling the UI thread with cProfile"""
+        if self.profile_var.get():
+            instrumentation.stats.start_profile()
+            return
+        path = os.path.join(os.path.dirname(metadata_index.DEFAULT_INDEX_PATH),
+                            time.strftime("profile-%Y%m%d-%H%M%S.prof"))
+        try:
+            instrumentation.stats.stop_profile(path)
+            messagebox.showinfo("Profile", f"Profile written to {path}")
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to write profile: {str(e)}")
+    
     def clear_metadata(self):
         self.metadata_text.delete(1.0, tk.END)
+        for field_id, start, end in self.field_marks:
+            self.metadata_text.mark_unset(start, end)
+        self.field_marks = []
+        for tag in self.collapsed_values:
+            self.metadata_text.tag_delete(tag)
+        self.collapsed_values = {}
+        self.current_document = None
         
     def run(self):
         self.window.mainloop()
+        if self.folder_watcher:
+            self.folder_watcher.stop()
+        self.metadata_loader.shutdown()
+        self.thumbnail_loader.shutdown()
 
 if __name__ == "__main__":
     app = ImageMetadataManager()
@@ -0,0 +1,167 @@
+"""Single file metadata operations used by the batch tools.
+
+Every operation takes the source path and a target path, which may be the
+same file, and returns the number of bytes of the source so callers can
+report throughput. PNG and JPEG files are rewritten at the container level
+and never re-encoded.
+"""
+import os
+import shutil
+
+import instrumentation
+import jpeg_segments
+import metadata_reader
+import png_chunks
+from atomic_file import atomic_write
+
+PNG_XMP_KEYWORD = b'XML:com.adobe.xmp\0'
+
+# What strip_metadata() can remove. ICC profiles affect how colors are
+# shown, so they are only removed when asked for.
+STRIP_CATEGORIES = ('exif', 'xmp', 'iptc', 'icc', 'comment', 'text')
+DEFAULT_STRIP = ('exif', 'xmp', 'iptc', 'comment', 'text')
+
+
+def _prepare_target(target):
+    directory = os.path.dirname(os.path.abspath(target))
+    os.makedirs(directory, exist_ok=True)
+
+
+def parse_categories(text):
+    """Parse a comma separated category list, 'all' selects every category"""
+    categories = tuple(name.strip().lower() for name in text.split(',') if name.strip())
+    if 'all' in categories:
+        return STRIP_CATEGORIES
+    unknown = [name for name in categories if name not in STRIP_CATEGORIES]
+    if unknown:
+        raise ValueError(f"Unknown metadata categories: {', '.join(unknown)}")
+    return categories
+
+
+def _jpeg_category(marker, data):
+    if marker == jpeg_segments.COM:
+        return 'comment'
+    if marker == jpeg_segments.APP1:
+        if data.startswith(jpeg_segments.EXIF_HEADER):
+            return 'exif'
+        if data.startswith((jpeg_segments.XMP_HEADER, jpeg_segments.XMP_EXTENSION_HEADER)):
+            return 'xmp'
+    elif marker == jpeg_segments.APP2 and data.startswith(jpeg_segments.ICC_HEADER):
+        return 'icc'
+    elif marker == jpeg_segments.APP13 and data.startswith(jpeg_segments.IPTC_HEADER):
+        return 'iptc'
+    return None
+
+
+def _png_chunk_types(categories):
+    """Return the chunk types to remove and a keep() filter for remove_chunks()"""
+    chunk_types = set()
+    if 'exif' in categories:
+        chunk_types.add(b'eXIf')
+    if 'icc' in categories:
+        chunk_types.add(b'iCCP')
+    strip_text = 'text' in categories
+    strip_xmp = 'xmp' in categories
+    if strip_text or strip_xmp:
+        chunk_types.update(png_chunks.TEXT_CHUNK_TYPES)
+    keep = None
+    if strip_text != strip_xmp:
+        # XMP is an iTXt chunk with a fixed keyword, sort it from the rest
+        def keep(chunk_type, data):
+            if chunk_type not in png_chunks.TEXT_CHUNK_TYPES:
+                return False
+            is_xmp = chunk_type == b'iTXt' and data.startswith(PNG_XMP_KEYWORD)
+            return is_xmp != strip_xmp
+    return chunk_types, keep
+
+
+def strip_metadata(path, target, categories=DEFAULT_STRIP, fsync=False):
+    """Remove metadata from an image, by default everything but ICC profiles
+
+    categories picks from STRIP_CATEGORIES. PNG and JPEG files are copied
+    chunk by chunk or segment by segment without touching the image data.
+    Other formats have no container level writer and raise ValueError; a
+    re-save through Pillow could drop frames or pages and recompress.
+    """
+    image_format = metadata_reader.file_format(path)
+    if image_format not in ('PNG', 'JPEG'):
+        raise ValueError("Removing metadata is only supported for PNG and JPEG files")
+    _prepare_target(target)
+    size = os.path.getsize(path)
+    with instrumentation.stage('write', op='strip', format=image_format):
+        if image_format == 'PNG':
+            chunk_types, keep = _png_chunk_types(categories)
+            png_chunks.remove_chunks(path, target, chunk_types, fsync=fsync, keep=keep)
+        else:
+            jpeg_segments.remove_segments(
+                path, target, lambda marker, data: _jpeg_category(marker, data) in categories, fsync=fsync)
+    return size
+
+
+def set_fields(path, target, fields, fsync=False, policy=png_chunks.DEFAULT_POLICY):
+    """Set metadata fields by name, a value of None removes the field
+
+    PNG fields are text chunk keywords, JPEG fields are EXIF tag names.
+    policy decides which new PNG text values are compressed.
+    """
+    _prepare_target(target)
+    image_format = metadata_reader.file_format(path)
+    if image_format not in ('PNG', 'JPEG'):
+        raise ValueError("Setting metadata is only supported for PNG and JPEG files")
+    with instrumentation.stage('write', op='set', format=image_format):
+        if image_format == 'PNG':
+            png_chunks.write_text_chunks(path, target, fields, fsync=fsync, policy=policy)
+        else:
+            jpeg_segments.update_exif_fields(path, target, fields, fsync=fsync)
+    return os.path.getsize(path)
+
+
+def recompress_metadata(path, target, threshold=png_chunks.COMPRESS_THRESHOLD,
+                        level=png_chunks.DEFAULT_ZLIB_LEVEL, fsync=False):
+    """Compress the large text chunks of a PNG file (zTXt / iTXt)
+
+    Only chunks that get smaller are rewritten. Other formats have no
+    compressed text chunks, they are left alone (or copied when target is
+    another file).
+    """
+    _prepare_target(target)
+    size = os.path.getsize(path)
+    if metadata_reader.file_format(path) == 'PNG':
+        policy = png_chunks.CompressionPolicy(threshold, level)
+        with instrumentation.stage('write', op='recompress', format='PNG'):
+            png_chunks.recompress_text_chunks(path, target, policy, fsync=fsync)
+    elif os.path.abspath(path) != os.path.abspath(target):
+        with atomic_write(target, fsync=fsync) as dst, open(path, 'rb') as src:
+            shutil.copyfileobj(src, dst, png_chunks.COPY_BUFFER_SIZE)
+    return size
+
+
+def source_fields(path, keys=None):
+    """Return the text metadata fields of an image, for copying to others
+
+    PNG files give their text chunks, JPEG files their ASCII typed EXIF
+    tags and UserComment. Binary tags such as MakerNote do not survive a
+    round trip through text, so they are never copied. keys limits the
+    result to the given field names.
+    """
+    meta = metadata_reader.read_metadata(path)
+    if meta.format == 'PNG':
+        fields = dict(meta.text)
+    else:
+        fields = {}
+        for tag, value in meta.exif.items():
+            if tag == 'UserComment':
+                fields[tag] = jpeg_segments.decode_user_comment(value)
+            elif isinstance(value, (str, bytes)) and tag in jpeg_segments.ASCII_FIELDS:
+                fields[tag] = value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+    if keys:
+        missing = [key for key in keys if key not in fields]
+        if missing:
+            raise ValueError(f"{path} has no field(s): {', '.join(missing)}")
+        fields = {key: fields[key] for key in keys}
+    return fields
+
+
+def export_record(path):
+    """Return the metadata of an image as a plain dict"""
+    return metadata_reader.read_metadata(path).as_record()
@@ -0,0 +1,272 @@
+"""Header only image metadata reader.
+
+Reads the container structure directly (PNG chunks, JPEG marker segments,
+TIFF IFDs) with a single open, and stops before the pixel data wherever
+the format allows it.
+"""
+import json
+import os
+import struct
+
+from PIL import ExifTags, Image, TiffImagePlugin
+
+import instrumentation
+import jpeg_segments
+import png_chunks
+
+PNG_COLOR_MODES = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+JPEG_COMPONENT_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+# SOF0-SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+TIFF_PREFIXES = (b'II*\0', b'MM\0*')
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+PROMPT_NODE_TYPES = ("CLIPTextEncode", "PromptSchedule")
+
+
+class ImageMetadata:
+    """Metadata of one image file, as read from its headers"""
+
+    def __init__(self, path, format=None, size=None, mode=None):
+        self.path = path
+        self.format = format
+        self.size = size
+        self.mode = mode
+        self.file_size = None
+        self.mtime_ns = None
+        # PNG text keyword -> value, and the chunks themselves in file order
+        self.text = {}
+        self.text_chunks = []
+        # EXIF tag name -> value, IFD0 merged with the Exif IFD like _getexif()
+        self.exif = {}
+        self.xmp = None
+        self.comment = None
+        # Decoded 'prompt' graph, parsed on first use
+        self._workflow = None
+        self._workflow_parsed = False
+
+    def __repr__(self):
+        return f"ImageMetadata({self.path!r}, {self.format}, {self.size}, {self.mode})"
+
+    def workflow(self):
+        """Return the decoded ComfyUI prompt graph, or None
+
+        The chunk is parsed once and the result kept, callers share it.
+        """
+        if not self._workflow_parsed:
+            self._workflow = None
+            try:
+                workflow = None
+                if 'prompt' in self.text:
+                    with instrumentation.stage('json_parse', key='prompt'):
+                        workflow = json.loads(self.text['prompt'])
+            except json.JSONDecodeError:
+                workflow = None
+            if isinstance(workflow, dict):
+                self._workflow = workflow
+            self._workflow_parsed = True
+        return self._workflow
+
+    def prompts(self):
+        """Return (source, text) pairs for every prompt found in the metadata
+
+        Sources are 'UserComment', 'parameters' or 'Node <id>' for the
+        CLIPTextEncode/PromptSchedule nodes of a ComfyUI prompt graph.
+        """
+        prompts = []
+        if 'UserComment' in self.exif:
+            prompts.append(('UserComment', jpeg_segments.decode_user_comment(self.exif['UserComment'])))
+        for node_id, node in (self.workflow() or {}).items():
+            if not isinstance(node, dict) or node.get("class_type") not in PROMPT_NODE_TYPES:
+                continue
+            if "inputs" in node and "text" in node["inputs"]:
+                prompts.append((f"Node {node_id}", str(node["inputs"]["text"])))
+            elif node.get("widgets_values"):
+                prompts.append((f"Node {node_id}", str(node["widgets_values"][0])))
+        if 'parameters' in self.text:
+            prompts.append(('parameters', self.text['parameters']))
+        return prompts
+
+    def exif_values(self):
+        """Return the EXIF tags with JSON friendly values"""
+        values = {}
+        for tag, value in self.exif.items():
+            if tag == 'UserComment':
+                value = jpeg_segments.decode_user_comment(value)
+            values[str(tag)] = _plain_value(value)
+        return values
+
+    def as_record(self):
+        """Return the metadata as a plain dict that can be serialized to JSON"""
+        width, height = self.size or (None, None)
+        return {
+            'path': self.path,
+            'format': self.format,
+            'width': width,
+            'height': height,
+            'mode': self.mode,
+            'file_size': self.file_size,
+            'mtime_ns': self.mtime_ns,
+            'exif': self.exif_values(),
+            'text_keys': list(self.text),
+            'prompts': [{'source': source, 'text': text} for source, text in self.prompts()],
+        }
+
+
+def detect_format(signature):
+    """Return 'PNG', 'JPEG' or 'TIFF' for the first bytes of a file, else None"""
+    if signature.startswith(png_chunks.PNG_SIGNATURE):
+        return 'PNG'
+    if signature.startswith(b'\xff\xd8'):
+        return 'JPEG'
+    if signature[:4] in TIFF_PREFIXES:
+        return 'TIFF'
+    return None
+
+
+def file_format(path):
+    """Detect the container format of a file from its signature"""
+    with open(path, 'rb') as f:
+        return detect_format(f.read(8))
+
+
+def read_metadata(path, trailing_text=True):
+    """Read the metadata of an image file without decoding its pixels
+
+    PNG files are walked chunk by chunk; with trailing_text the walk skips
+    over the IDAT chunks to pick up text chunks stored after the image data,
+    otherwise it stops at the first IDAT. JPEG files are read up to the
+    start of scan and TIFF files only have their IFDs read. Other formats
+    fall back to Pillow, which also only parses the header on open.
+    """
+    with instrumentation.stage('open'):
+        f = open(path, 'rb')
+    with f, instrumentation.stage('decode_headers'):
+        st = os.fstat(f.fileno())
+        image_format = detect_format(f.read(8))
+        f.seek(0)
+        if image_format == 'PNG':
+            meta = _read_png(path, f, trailing_text)
+        elif image_format == 'JPEG':
+            meta = _read_jpeg(path, f)
+        elif image_format == 'TIFF':
+            meta = _read_tiff(path, f)
+        else:
+            meta = _read_with_pillow(path, f)
+    meta.file_size = st.st_size
+    meta.mtime_ns = st.st_mtime_ns
+    return meta
+
+
+def _read_png(path, f, trailing_text):
+    meta = ImageMetadata(path, 'PNG')
+    for chunk_type, length, offset in png_chunks.iter_chunks(f):
+        if chunk_type == b'IHDR':
+            width, height, bit_depth, color_type = struct.unpack('>IIBB', png_chunks.read_exact(f, 10))
+            meta.size = (width, height)
+            meta.mode = PNG_COLOR_MODES.get(color_type)
+            if color_type == 0 and bit_depth == 1:
+                meta.mode = '1'
+            elif color_type == 0 and bit_depth == 16:
+                meta.mode = 'I;16'
+        elif chunk_type in png_chunks.TEXT_CHUNK_TYPES:
+            chunk = png_chunks.decode_text_chunk(chunk_type, png_chunks.read_exact(f, length))
+            meta.text_chunks.append(chunk)
+            meta.text[chunk.key] = chunk.value
+        elif chunk_type == b'eXIf':
+            meta.exif = _decode_exif(png_chunks.read_exact(f, length))
+        elif chunk_type == b'IDAT' and not trailing_text:
+            break
+    return meta
+
+
+def _read_jpeg(path, f):
+    meta = ImageMetadata(path, 'JPEG')
+    for marker, length, offset in jpeg_segments.iter_segments(f):
+        if marker in JPEG_SOF_MARKERS and length >= 6:
+            height, width, components = struct.unpack('>HHB', jpeg_segments.read_exact(f, 6)[1:])
+            meta.size = (width, height)
+            meta.mode = JPEG_COMPONENT_MODES.get(components)
+        elif marker == jpeg_segments.APP1:
+            data = jpeg_segments.read_exact(f, length)
+            if data.startswith(jpeg_segments.EXIF_HEADER):
+                meta.exif = _decode_exif(data)
+            elif data.startswith(jpeg_segments.XMP_HEADER):
+                meta.xmp = data.split(b'\0', 1)[1].decode('utf-8', 'replace')
+        elif marker == jpeg_segments.COM:
+            meta.comment = jpeg_segments.read_exact(f, length).decode('utf-8', 'replace')
+    return meta
+
+
+def _read_tiff(path, f):
+    meta = ImageMetadata(path, 'TIFF')
+    header = f.read(8)
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(header)
+    f.seek(ifd.next)
+    ifd.load(f)
+    meta.exif = _named_tags(ifd)
+    if EXIF_IFD_POINTER in ifd:
+        exif_ifd = TiffImagePlugin.ImageFileDirectory_v2(header)
+        f.seek(ifd[EXIF_IFD_POINTER])
+        exif_ifd.load(f)
+        meta.exif.update(_named_tags(exif_ifd))
+    width, height = ifd.get(256), ifd.get(257)
+    if width and height:
+        meta.size = (width, height)
+    meta.mode = _tiff_mode(ifd)
+    return meta
+
+
+def _read_with_pillow(path, f):
+    with Image.open(f) as img:
+        meta = ImageMetadata(path, img.format, img.size, img.mode)
+        meta.exif = _named_tags(img.getexif())
+        if isinstance(img.info.get('comment'), bytes):
+            meta.comment = img.info['comment'].decode('utf-8', 'replace')
+    return meta
+
+
+def _decode_exif(data):
+    exif = Image.Exif()
+    exif.load(data)
+    tags = _named_tags(exif)
+    tags.update(_named_tags(exif.get_ifd(EXIF_IFD_POINTER)))
+    gps = exif.get_ifd(GPS_IFD_POINTER)
+    if gps:
+        tags['GPSInfo'] = {ExifTags.GPSTAGS.get(k, k): v for k, v in gps.items()}
+    return tags
+
+
+def _named_tags(tags):
+    return {ExifTags.TAGS.get(tag, tag): value for tag, value in tags.items()
+            if tag not in (EXIF_IFD_POINTER, GPS_IFD_POINTER)}
+
+
+def _plain_value(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace').rstrip('\0')
+    if isinstance(value, (tuple, list)):
+        return [_plain_value(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _plain_value(v) for k, v in value.items()}
+    if isinstance(value, TiffImagePlugin.IFDRational):
+        return float(value) if value.denominator else None
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def _tiff_mode(ifd):
+    photometric = ifd.get(262)
+    samples = ifd.get(277, 1)
+    bits = ifd.get(258, (1,))
+    bits = bits[0] if isinstance(bits, tuple) else bits
+    if photometric in (0, 1):
+        return '1' if bits == 1 else ('I;16' if bits == 16 else 'L')
+    if photometric in (2, 6):
+        return 'RGBA' if samples == 4 else 'RGB'
+    if photometric == 3:
+        return 'P'
+    if photometric == 5:
+        return 'CMYK'
+    return None
@@ -0,0 +1,182 @@
+"""Builds the viewer's metadata text from a MetadataDocument.
+
+The whole text is assembled up front as a list of (text, tags) parts so the
+viewer can fill its Text widget with a single insert. Large JSON values are
+not formatted at all until the user expands them, and then only a page at
+a time.
+"""
+import json
+import os
+
+import instrumentation
+
+# JSON values longer than this are shown collapsed
+COLLAPSE_CHARS = 64 * 1024
+# Characters of formatted JSON added per expansion
+PAGE_CHARS = 256 * 1024
+RULE = "-" * 40 + "\n"
+
+
+def _format_size(nbytes):
+    if nbytes < 1024:
+        return f"{nbytes} bytes"
+    if nbytes < 1024 * 1024:
+        return f"{nbytes / 1024:.1f} KB"
+    return f"{nbytes / (1024 * 1024):.1f} MB"
+
+
+class CollapsedValue:
+    """A large JSON value shown as a one line summary until expanded
+
+    Expanding formats the value lazily with JSONEncoder.iterencode(), so
+    each page only costs what it shows and the full pretty-printed text of
+    a multi-megabyte workflow is never built at once.
+    """
+
+    def __init__(self, key, text, parsed=None):
+        self.key = key
+        self.text = text
+        self.parsed = parsed
+        self.chunks = None
+        self.shown = 0
+        self.finished = False
+
+    def summary(self):
+        return f"[{self.key}: {_format_size(len(self.text))} of JSON, click to expand]\n"
+
+    def more(self):
+        return f"[... {_format_size(self.shown)} shown, click to show more]\n"
+
+    def next_page(self, page_chars=PAGE_CHARS):
+        """Return the next page of the formatted value"""
+        if self.chunks is None:
+            if self.parsed is None:
+                try:
+                    with instrumentation.stage('json_parse', key=self.key):
+                        self.parsed = json.loads(self.text)
+                except json.JSONDecodeError:
+                    self.parsed = None
+            if self.parsed is None:
+                # Not JSON after all, page through the raw text
+                text = self.text
+                self.chunks = iter(text[i:i + page_chars] for i in range(0, len(text), page_chars))
+            else:
+                self.chunks = json.JSONEncoder(indent=2).iterencode(self.parsed)
+        page = []
+        size = 0
+        for chunk in self.chunks:
+            page.append(chunk)
+            size += len(chunk)
+            if size >= page_chars:
+                break
+        else:
+            self.finished = True
+            page.append("\n\n")
+        self.shown += size
+        return ''.join(page)
+
+
+class RenderedMetadata:
+    """Text parts of the rendered metadata plus what the viewer hooks up
+
+    fields lists (field_id, head_tag, tail_tag): the field's value sits
+    between the text tagged head_tag and the text tagged tail_tag.
+    collapsed maps the tag of each summary line to its CollapsedValue.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.fields = []
+        self.collapsed = {}
+
+    def add(self, text, tag=None):
+        self.parts.append((text, (tag,) if tag else ()))
+
+    def add_field(self, field):
+        n = len(self.fields)
+        head, tail = f"field{n}.head", f"field{n}.tail"
+        self.add(f"PROMPT ({field.label}):\n", head)
+        self.add(field.value)
+        self.add("\n\n", tail)
+        self.fields.append((field.id, head, tail))
+
+    def add_collapsed(self, value):
+        tag = f"collapsed{len(self.collapsed)}"
+        self.collapsed[tag] = value
+        self.add(value.summary(), tag)
+
+    def insert_args(self):
+        """Arguments for Text.insert() after the index: chars, tags, ..."""
+        args = []
+        for text, tags in self.parts:
+            args.append(text)
+            args.append(tags)
+        return args
+
+
+def render(document):
+    """Render a MetadataDocument the way the viewer shows it"""
+    meta = document.meta
+    out = RenderedMetadata()
+    out.add(f"File: {os.path.basename(meta.path)}\n")
+    out.add(f"Size: {meta.size}\n")
+    out.add(f"Format: {meta.format}\n")
+    out.add(f"Mode: {meta.mode}\n\n")
+
+    if meta.format == "JPEG":
+        # JPEG: UserComment holds the prompt
+        if meta.exif:
+            out.add("EXIF Data:\n" + RULE)
+            for tag, value in meta.exif.items():
+                if tag == "UserComment":
+                    field = document.fields[('exif', 'UserComment')]
+                    out.add_field(field)
+                    value = field.original
+                out.add(f"{tag}: {value}\n")
+        else:
+            out.add("No EXIF data found\n")
+
+    elif meta.format == "PNG":
+        if meta.text:
+            out.add("PNG Metadata:\n" + RULE)
+            # Positive prompts from the workflow nodes, then traditional parameters
+            for field in document.fields.values():
+                out.add_field(field)
+            out.add("All Metadata:\n" + RULE)
+            for key, value in meta.text.items():
+                _add_text_value(out, meta, key, value)
+        else:
+            out.add("No PNG metadata found\n")
+
+    else:
+        # TIFF/BMP/GIF: standard metadata
+        if meta.exif:
+            out.add("EXIF Data:\n" + RULE)
+            for tag, value in meta.exif.items():
+                out.add(f"{tag}: {value}\n")
+        else:
+            out.add("No metadata found\n")
+
+    if not document.fields:
+        out.add("\nNo prompt found in metadata.\n")
+    return out
+
+
+def _add_text_value(out, meta, key, value):
+    out.add(f"{key}:\n")
+    looks_like_json = isinstance(value, str) and value.startswith(('{', '['))
+    # The prompt graph is already decoded, reuse it instead of parsing again
+    parsed = meta.workflow() if key == 'prompt' else None
+    if looks_like_json and len(value) > COLLAPSE_CHARS:
+        out.add_collapsed(CollapsedValue(key, value, parsed))
+        return
+    if looks_like_json:
+        if parsed is None:
+            try:
+                with instrumentation.stage('json_parse', key=key):
+                    parsed = json.loads(value)
+            except json.JSONDecodeError:
+                parsed = None
+        if parsed is not None:
+            value = json.dumps(parsed, indent=2)
+    out.add(f"{value}\n\n")
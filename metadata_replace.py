@@ -0,0 +1,174 @@
+"""Batch find and replace in prompt text.
+
+A Replacement is applied wherever a prompt lives: the JPEG EXIF
+UserComment, the PNG 'parameters' text and the text of the ComfyUI graphs
+stored in the PNG 'prompt' and 'workflow' chunks, i.e. node inputs.text
+and the string entries of node widgets_values. Files are rewritten at the
+container level like every other edit, and only when something matched.
+"""
+import difflib
+import json
+import os
+import re
+import shutil
+
+import instrumentation
+import jpeg_segments
+import metadata_ops
+import metadata_reader
+import png_chunks
+from atomic_file import atomic_write
+
+# PNG text chunks holding a ComfyUI graph as JSON
+GRAPH_KEYS = ('prompt', 'workflow')
+# Characters json.dumps() writes as escapes. A literal without any of them
+# appears verbatim in the JSON text of every string that contains it.
+_JSON_ESCAPED = re.compile('["\\\\\x00-\x1f\x7f-\U0010ffff]')
+
+
+class Replacement:
+    """A literal or regular expression substitution
+
+    With regex=True, replace may refer to groups (\\1, \\g<name>);
+    otherwise both strings are taken literally.
+    """
+
+    def __init__(self, find, replace, regex=False, ignore_case=False):
+        if not find:
+            raise ValueError("Nothing to find")
+        self.find = find
+        self.replace = replace
+        self.regex = regex
+        self.ignore_case = ignore_case
+        self.pattern = re.compile(find if regex else re.escape(find), re.IGNORECASE if ignore_case else 0)
+        self.template = replace if regex else replace.replace('\\', '\\\\')
+        # Compiles the template, so bad group references fail here
+        # rather than once per file
+        self.pattern.subn(self.template, '')
+
+    def subn(self, text):
+        return self.pattern.subn(self.template, text)
+
+    def may_match(self, raw_json):
+        """Return False if nothing in the JSON text raw_json can match
+
+        Lets files without the search term skip parsing their graphs,
+        which is most of the work for large ComfyUI workflows.
+        """
+        if self.regex or _JSON_ESCAPED.search(self.find):
+            return True
+        if self.ignore_case:
+            return self.find.lower() in raw_json.lower()
+        return self.find in raw_json
+
+
+class Change:
+    """Replacements made in one field of a file
+
+    diff is a unified diff of the field, only filled in for dry runs.
+    """
+
+    def __init__(self, field, count, diff=None):
+        self.field = field
+        self.count = count
+        self.diff = diff
+
+    def __repr__(self):
+        return f"Change({self.field!r}, {self.count})"
+
+
+def _diff(path, field, old, new):
+    lines = difflib.unified_diff(old.splitlines(), new.splitlines(),
+                                 f"{path}:{field}", f"{path}:{field}", lineterm='')
+    return '\n'.join(lines)
+
+
+class _Replacer:
+    """Applies a Replacement to the fields of one file, recording changes"""
+
+    def __init__(self, path, replacement, dry_run):
+        self.path = path
+        self.replacement = replacement
+        self.dry_run = dry_run
+        self.changes = []
+
+    def apply(self, field, text):
+        new_text, count = self.replacement.subn(text)
+        if count:
+            diff = _diff(self.path, field, text, new_text) if self.dry_run else None
+            self.changes.append(Change(field, count, diff))
+        return new_text
+
+    def apply_graph(self, key, graph):
+        """Replace in the node texts of a parsed graph, return True if any changed"""
+        changed = len(self.changes)
+        if isinstance(graph.get('nodes'), list):
+            # UI workflow: a list of nodes carrying their own ids
+            nodes = ((node.get('id'), node) for node in graph['nodes'] if isinstance(node, dict))
+        else:
+            # API prompt: node id -> node
+            nodes = graph.items()
+        for node_id, node in nodes:
+            if not isinstance(node, dict):
+                continue
+            inputs = node.get('inputs')
+            if isinstance(inputs, dict) and isinstance(inputs.get('text'), str):
+                inputs['text'] = self.apply(f"{key}:{node_id}.inputs.text", inputs['text'])
+            values = node.get('widgets_values')
+            if isinstance(values, list):
+                for i, value in enumerate(values):
+                    if isinstance(value, str):
+                        values[i] = self.apply(f"{key}:{node_id}.widgets_values[{i}]", value)
+        return len(self.changes) > changed
+
+
+def replace_in_file(path, target, replacement, dry_run=False, fsync=False,
+                    policy=png_chunks.DEFAULT_POLICY):
+    """Apply replacement to the prompt text of an image, writing to target
+
+    Returns the size of the source and the list of Changes. With dry_run
+    nothing is written and every Change carries its diff. A file without
+    matches is left alone, or copied when target is another file. Only PNG
+    and JPEG files hold prompts; other formats never match. policy decides
+    which rewritten PNG text values are compressed.
+    """
+    size = os.path.getsize(path)
+    meta = metadata_reader.read_metadata(path)
+    replacer = _Replacer(path, replacement, dry_run)
+    updates = {}
+    if meta.format == 'JPEG' and 'UserComment' in meta.exif:
+        value = jpeg_segments.decode_user_comment(meta.exif['UserComment'])
+        new_value = replacer.apply('UserComment', value)
+        if new_value != value:
+            updates['UserComment'] = new_value
+    elif meta.format == 'PNG':
+        value = meta.text.get('parameters')
+        if isinstance(value, str):
+            new_value = replacer.apply('parameters', value)
+            if new_value != value:
+                updates['parameters'] = new_value
+        for key in GRAPH_KEYS:
+            raw = meta.text.get(key)
+            if not isinstance(raw, str) or not replacement.may_match(raw):
+                continue
+            if key == 'prompt':
+                graph = meta.workflow()
+            else:
+                try:
+                    with instrumentation.stage('json_parse', key=key):
+                        graph = json.loads(raw)
+                except json.JSONDecodeError:
+                    graph = None
+            if isinstance(graph, dict) and replacer.apply_graph(key, graph):
+                with instrumentation.stage('encode'):
+                    updates[key] = json.dumps(graph)
+
+    if dry_run:
+        return size, replacer.changes
+    if updates:
+        metadata_ops.set_fields(path, target, updates, fsync=fsync, policy=policy)
+    elif os.path.abspath(path) != os.path.abspath(target):
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        with atomic_write(target, fsync=fsync) as dst, open(path, 'rb') as src:
+            shutil.copyfileobj(src, dst, png_chunks.COPY_BUFFER_SIZE)
+    return size, replacer.changes
@@ -0,0 +1,293 @@
+"""Chunk level PNG reading and writing.
+
+Editing a text chunk only needs the chunks around it copied verbatim, so the
+writer here never decodes or re-compresses the pixel data (IDAT).
+"""
+import os
+import struct
+import zlib
+
+from atomic_file import atomic_write
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNK_TYPES = (b'tEXt', b'zTXt', b'iTXt')
+CRITICAL_CHUNK_TYPES = (b'IHDR', b'PLTE', b'IDAT', b'IEND')
+COPY_BUFFER_SIZE = 1024 * 1024
+# Encoded values of at least this many bytes are written compressed
+COMPRESS_THRESHOLD = 16 * 1024
+DEFAULT_ZLIB_LEVEL = 6
+# The XMP specification requires its iTXt chunk to stay uncompressed
+XMP_KEYWORD = 'XML:com.adobe.xmp'
+
+
+class PngFormatError(ValueError):
+    """Raised when a file is not a well formed PNG stream"""
+
+
+class CompressionPolicy:
+    """Decides which text chunks are written compressed, and how hard
+
+    Values whose encoded size reaches threshold bytes become zTXt (Latin-1
+    text) or compressed iTXt chunks at the given zlib level; a threshold of
+    None never compresses.
+    """
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=DEFAULT_ZLIB_LEVEL):
+        if not 0 <= level <= 9:
+            raise ValueError(f"zlib level must be between 0 and 9, got {level}")
+        self.threshold = threshold
+        self.level = level
+
+    def should_compress(self, key, nbytes):
+        return self.threshold is not None and nbytes >= self.threshold and key != XMP_KEYWORD
+
+    def __repr__(self):
+        return f"CompressionPolicy(threshold={self.threshold}, level={self.level})"
+
+
+DEFAULT_POLICY = CompressionPolicy()
+NO_COMPRESSION = CompressionPolicy(threshold=None)
+
+
+class TextChunk:
+    """A decoded tEXt, zTXt or iTXt chunk"""
+
+    def __init__(self, key, value, chunk_type=b'tEXt', compressed=False, lang='', translated_key=''):
+        self.key = key
+        self.value = value
+        self.chunk_type = chunk_type
+        self.compressed = compressed
+        self.lang = lang
+        self.translated_key = translated_key
+
+    def __repr__(self):
+        return f"TextChunk({self.key!r}, {self.chunk_type.decode('ascii')}, {len(self.value)} chars)"
+
+
+def read_exact(f, count):
+    """Read exactly count bytes or raise PngFormatError"""
+    data = f.read(count)
+    if len(data) != count:
+        raise PngFormatError("Unexpected end of PNG data")
+    return data
+
+
+def iter_chunks(f):
+    """Walk the chunks of an open PNG file
+
+    Yields (chunk_type, length, offset) where offset is the start of the
+    chunk header. The file is left positioned at the start of the chunk
+    data; the caller may read it or not, the walk resumes at the next chunk
+    either way.
+    """
+    f.seek(0)
+    if f.read(8) != PNG_SIGNATURE:
+        raise PngFormatError("Not a PNG file")
+    offset = 8
+    while True:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            if header:
+                raise PngFormatError("Truncated PNG chunk header")
+            return  # Missing IEND, tolerate it like Pillow does
+        length, chunk_type = struct.unpack('>I4s', header)
+        yield chunk_type, length, offset
+        offset += length + 12
+        if chunk_type == b'IEND':
+            return
+
+
+def make_chunk(chunk_type, data):
+    """Serialize a chunk including its length and CRC"""
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def decode_text_chunk(chunk_type, data):
+    """Decode the payload of a tEXt, zTXt or iTXt chunk into a TextChunk"""
+    key, _, rest = data.partition(b'\0')
+    key = key.decode('latin-1')
+    if chunk_type == b'tEXt':
+        return TextChunk(key, rest.decode('latin-1'), chunk_type)
+    if chunk_type == b'zTXt':
+        # First byte is the compression method, 0 (deflate) is the only one defined
+        value = zlib.decompress(rest[1:]).decode('latin-1')
+        return TextChunk(key, value, chunk_type, compressed=True)
+    if chunk_type == b'iTXt':
+        if len(rest) < 2:
+            raise PngFormatError(f"Malformed iTXt chunk {key!r}")
+        compressed = rest[0] == 1
+        lang, _, rest = rest[2:].partition(b'\0')
+        translated_key, _, value = rest.partition(b'\0')
+        if compressed:
+            value = zlib.decompress(value)
+        return TextChunk(key, value.decode('utf-8', 'replace'), chunk_type, compressed=compressed,
+                         lang=lang.decode('latin-1'), translated_key=translated_key.decode('utf-8', 'replace'))
+    raise PngFormatError(f"Not a text chunk: {chunk_type!r}")
+
+
+def encode_text_chunk(key, value, policy=DEFAULT_POLICY, like=None):
+    """Encode a keyword/value pair as (chunk_type, data)
+
+    Like Pillow's PngInfo.add_text(), values that fit in Latin-1 become tEXt
+    and anything else becomes an iTXt chunk; policy decides whether they are
+    compressed (zTXt or compressed iTXt). like is the TextChunk being
+    replaced, if any: an iTXt chunk stays iTXt with its language tags and a
+    compressed chunk stays compressed.
+    """
+    try:
+        key_bytes = key.encode('latin-1')
+    except UnicodeEncodeError:
+        raise ValueError(f"PNG keyword must be Latin-1: {key!r}")
+    if not 1 <= len(key_bytes) <= 79 or b'\0' in key_bytes:
+        raise ValueError(f"Invalid PNG keyword: {key!r}")
+    latin1 = None
+    if like is None or like.chunk_type != b'iTXt':
+        try:
+            latin1 = value.encode('latin-1')
+        except UnicodeEncodeError:
+            pass
+    raw = latin1 if latin1 is not None else value.encode('utf-8')
+    compress = policy.should_compress(key, len(raw)) or (
+        like is not None and like.compressed and key != XMP_KEYWORD)
+    if latin1 is not None:
+        if compress:
+            return b'zTXt', key_bytes + b'\0\0' + zlib.compress(raw, policy.level)
+        return b'tEXt', key_bytes + b'\0' + raw
+    lang = like.lang.encode('latin-1', 'replace') if like is not None else b''
+    translated_key = like.translated_key.encode('utf-8') if like is not None else b''
+    if compress:
+        raw = zlib.compress(raw, policy.level)
+    header = key_bytes + b'\0' + (b'\1\0' if compress else b'\0\0')
+    return b'iTXt', header + lang + b'\0' + translated_key + b'\0' + raw
+
+
+def read_text_chunks(f):
+    """Return the TextChunks of an open PNG file in file order
+
+    IDAT chunks are skipped with a seek, so only the headers and text
+    payloads are read.
+    """
+    chunks = []
+    for chunk_type, length, offset in iter_chunks(f):
+        if chunk_type in TEXT_CHUNK_TYPES:
+            chunks.append(decode_text_chunk(chunk_type, read_exact(f, length)))
+    return chunks
+
+
+def copy_bytes(src, dst, count):
+    """Copy count bytes from src to dst in bounded blocks"""
+    while count > 0:
+        block = src.read(min(count, COPY_BUFFER_SIZE))
+        if not block:
+            raise PngFormatError("Unexpected end of PNG data")
+        dst.write(block)
+        count -= len(block)
+
+
+def write_text_chunks(src_path, dst_path, updates, fsync=False, policy=DEFAULT_POLICY):
+    """Copy a PNG file replacing only the given text chunks
+
+    updates maps keyword -> new text; a value of None removes the keyword.
+    A replaced keyword keeps its position in the file, keywords that do not
+    exist yet are added before the first IDAT chunk. Every other chunk,
+    including text chunks whose value did not change, is copied byte for
+    byte, so their type and compression stay as they were. New values are
+    encoded according to policy. src_path and dst_path may be the same file.
+    """
+    pending = dict(updates)
+    with atomic_write(dst_path, fsync=fsync) as dst:
+        with open(src_path, 'rb') as src:
+            dst.write(PNG_SIGNATURE)
+            for chunk_type, length, offset in iter_chunks(src):
+                if chunk_type in (b'IDAT', b'IEND') and pending:
+                    # Whatever is still pending goes in front of the pixel
+                    # data so header only readers find it. A keyword that
+                    # also appears after IDAT is dropped there instead.
+                    for key, value in pending.items():
+                        if value is not None:
+                            dst.write(make_chunk(*encode_text_chunk(key, value, policy)))
+                    pending.clear()
+                header = struct.pack('>I', length) + chunk_type
+                if chunk_type in TEXT_CHUNK_TYPES:
+                    data = read_exact(src, length)
+                    key = data.split(b'\0', 1)[0].decode('latin-1')
+                    if key in updates:
+                        if key not in pending:
+                            continue  # Duplicate of a keyword already written
+                        value = pending.pop(key)
+                        if value is None:
+                            continue
+                        old = decode_text_chunk(chunk_type, data)
+                        if old.value != value:
+                            dst.write(make_chunk(*encode_text_chunk(key, value, policy, like=old)))
+                            continue
+                    dst.write(header + data)
+                    copy_bytes(src, dst, 4)
+                    continue
+                dst.write(header)
+                copy_bytes(src, dst, length + 4)
+
+
+def remove_chunks(src_path, dst_path, chunk_types, fsync=False, keep=None):
+    """Copy a PNG file leaving out every chunk whose type is in chunk_types
+
+    keep(chunk_type, data) may spare individual chunks of those types, it
+    is only called (and the chunk data only read) for them. Returns the
+    number of chunks removed. Critical chunks (IHDR, PLTE, IDAT, IEND) are
+    always kept.
+    """
+    removed = 0
+    with atomic_write(dst_path, fsync=fsync) as dst:
+        with open(src_path, 'rb') as src:
+            dst.write(PNG_SIGNATURE)
+            for chunk_type, length, offset in iter_chunks(src):
+                if chunk_type in chunk_types and chunk_type not in CRITICAL_CHUNK_TYPES:
+                    if keep is None:
+                        removed += 1
+                        continue
+                    data = read_exact(src, length)
+                    if not keep(chunk_type, data):
+                        removed += 1
+                        continue
+                    dst.write(struct.pack('>I', length) + chunk_type + data)
+                    copy_bytes(src, dst, 4)  # CRC
+                    continue
+                dst.write(struct.pack('>I', length) + chunk_type)
+                copy_bytes(src, dst, length + 4)
+    return removed
+
+
+def recompress_text_chunks(src_path, dst_path, policy, fsync=False):
+    """Copy a PNG file re-encoding its text chunks according to policy
+
+    A chunk is only replaced when its new encoding is smaller, so values
+    below the threshold and chunks that are already compressed well are
+    copied as they are. Returns the number of bytes saved; when nothing
+    shrinks and src_path is dst_path the file is left untouched.
+    """
+    replacements = {}
+    saved = 0
+    with open(src_path, 'rb') as src:
+        for chunk_type, length, offset in iter_chunks(src):
+            if chunk_type not in TEXT_CHUNK_TYPES:
+                continue
+            chunk = decode_text_chunk(chunk_type, read_exact(src, length))
+            like = chunk if chunk.chunk_type == b'iTXt' else None
+            new_type, new_data = encode_text_chunk(chunk.key, chunk.value, policy, like=like)
+            if len(new_data) < length:
+                replacements[offset] = make_chunk(new_type, new_data)
+                saved += length - len(new_data)
+    if not replacements and os.path.abspath(src_path) == os.path.abspath(dst_path):
+        return 0
+    with atomic_write(dst_path, fsync=fsync) as dst:
+        with open(src_path, 'rb') as src:
+            dst.write(PNG_SIGNATURE)
+            for chunk_type, length, offset in iter_chunks(src):
+                if offset in replacements:
+                    dst.write(replacements[offset])
+                    continue
+                dst.write(struct.pack('>I', length) + chunk_type)
+                copy_bytes(src, dst, length + 4)
+    return saved
@@ -0,0 +1,87 @@
+"""Shared plumbing for the SQLite indexes keyed by file path.
+
+MetadataIndex and FingerprintIndex both keep one row per path with the file
+size and mtime it was computed from, so a refresh only redoes the files that
+changed since. This holds the connection setup, the batched path lookups,
+the staleness check and the row writes they have in common.
+"""
+import os
+import sqlite3
+import threading
+
+# SQLite versions before 3.32 allow at most 999 bound parameters
+QUERY_BATCH_SIZE = 900
+COMMIT_BATCH_SIZE = 500
+
+
+class SQLiteIndex:
+    """Rows of TABLE keyed by path, each remembering size and mtime_ns
+
+    Subclasses set TABLE, SCHEMA and UPSERT. The connection is shared
+    between threads and guarded by a lock, so the GUI can query an index
+    while a background thread refreshes it.
+    """
+
+    TABLE = None
+    SCHEMA = None
+    UPSERT = None
+    # Columns stale_paths() hands to its incomplete() check
+    STALE_COLUMNS = ('size', 'mtime_ns')
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def stored_rows(self, paths, columns=('size', 'mtime_ns')):
+        """Return {path: row} with the given columns for paths in the index"""
+        paths = list(paths)
+        select = ', '.join(('path',) + tuple(columns))
+        rows = {}
+        with self.lock:
+            for i in range(0, len(paths), QUERY_BATCH_SIZE):
+                batch = paths[i:i + QUERY_BATCH_SIZE]
+                for row in self.conn.execute(
+                        f"SELECT {select} FROM {self.TABLE} WHERE path IN ({','.join('?' * len(batch))})", batch):
+                    rows[row['path']] = row
+        return rows
+
+    def stale_paths(self, paths, incomplete=None):
+        """Return the paths that are missing from the index or changed on disk
+
+        incomplete(row), if given, marks up to date rows that still need
+        refreshing; it sees the STALE_COLUMNS of the row.
+        """
+        stored = self.stored_rows(paths, self.STALE_COLUMNS)
+        stale = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            row = stored.get(path)
+            if row is None or (row['size'], row['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+                stale.append(path)
+            elif incomplete and incomplete(row):
+                stale.append(path)
+        return stale
+
+    def forget(self, paths):
+        """Drop the given paths from the index"""
+        with self.lock, self.conn:
+            self.conn.executemany(f"DELETE FROM {self.TABLE} WHERE path = ?", [(path,) for path in paths])
+
+    def _store_rows(self, rows):
+        with self.lock, self.conn:
+            self.conn.executemany(self.UPSERT, rows)
@@ -0,0 +1,43 @@
+import unittest
+
+import fingerprint_index
+
+
+def _signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class SimilarGroupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = fingerprint_index.FingerprintIndex(':memory:')
+
+    def tearDown(self):
+        self.index.close()
+
+    def store(self, hashes):
+        self.index._store_rows([{'path': path, 'size': 0, 'mtime_ns': 0, 'content_hash': None,
+                                 'dhash': _signed(value), 'error': None} for path, value in hashes.items()])
+
+    def similar(self, hashes, distance):
+        self.store(hashes)
+        try:
+            return self.index.similar_groups(list(hashes), distance)
+        finally:
+            self.index.forget(hashes)
+
+    def test_every_allowed_distance(self):
+        base = 0x0123456789ABCDEF
+        for distance in range(65):
+            with self.subTest(distance=distance):
+                # Flip the top bits, which only the last band covers when
+                # the bands do not divide 64 evenly
+                near = base ^ (((1 << distance) - 1) << (64 - distance))
+                self.assertEqual(self.similar({'base': base, 'near': near}, distance), [['base', 'near']])
+                if distance < 64:
+                    far = base ^ ((1 << (distance + 1)) - 1)
+                    self.assertEqual(self.similar({'base': base, 'far': far}, distance), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+import jpeg_segments
+import metadata_reader
+
+
+class UpdateExifFieldsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip_on_pillow_exif(self):
+        # Pillow writes UNDEFINED tags with numeric types, which piexif
+        # loads as int or tuple
+        exif = Image.Exif()
+        exif[0x013B] = 'Someone'
+        exif_ifd = exif.get_ifd(0x8769)
+        exif_ifd[0x9286] = b'ASCII\0\0\0a prompt'
+        exif_ifd[0x9101] = b'\1\2\3\0'
+        exif_ifd[0xA300] = b'\3'
+        exif_ifd[0xA301] = b'\1'
+        src = os.path.join(self.directory, 'src.jpg')
+        dst = os.path.join(self.directory, 'dst.jpg')
+        Image.new('RGB', (8, 8)).save(src, exif=exif)
+
+        jpeg_segments.update_exif_fields(src, dst, {'Artist': 'Someone else'})
+
+        meta = metadata_reader.read_metadata(dst)
+        self.assertEqual(meta.exif['Artist'], 'Someone else')
+        self.assertEqual(jpeg_segments.decode_user_comment(meta.exif['UserComment']), 'a prompt')
+        self.assertEqual(meta.exif['ComponentsConfiguration'], b'\1\2\3\0')
+        self.assertEqual(meta.exif['FileSource'], b'\3')
+        self.assertEqual(meta.exif['SceneType'], b'\1')
+        with Image.open(src) as before, Image.open(dst) as after:
+            self.assertEqual(before.tobytes(), after.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+"""Thumbnails for the file list, generated in the background and kept on disk.
+
+Images are decoded at reduced size where the format allows it: JPEG through
+draft(), which lets libjpeg scale by 1/2 to 1/8 while decoding, and other
+formats through thumbnail()'s reducing_gap, which shrinks by a whole factor
+with reduce() before the final resample. Finished thumbnails are stored as
+small PNGs named by a hash of the source path, size and mtime, so a changed
+file gets a fresh thumbnail and the stale one ages out through size based
+eviction.
+"""
+import hashlib
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import instrumentation
+from atomic_file import atomic_write
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.metadata_manager', 'thumbnails')
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+# Longest side of a thumbnail in pixels
+THUMBNAIL_SIZE = 64
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+# Eviction trims the cache to this fraction of its limit, so it runs rarely
+EVICT_TO = 0.9
+
+
+def make_thumbnail(path, size=THUMBNAIL_SIZE):
+    """Return an RGB or RGBA thumbnail of path, at most size pixels square"""
+    with Image.open(path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (size, size))
+        elif img.mode.startswith('I;16'):
+            # Resampling does not support 16 bit modes, scale to 8 bits
+            img = img.convert('I').point(lambda v: v / 256).convert('L')
+        img.thumbnail((size, size), Image.BILINEAR, reducing_gap=2.0)
+        if img.mode in ('RGB', 'RGBA'):
+            return img.copy()
+        transparent = 'A' in img.getbands() or 'transparency' in img.info
+        return img.convert('RGBA' if transparent else 'RGB')
+
+
+class ThumbnailCache:
+    """Thumbnail files on disk, bounded by their total size
+
+    Entries are keyed by the source's absolute path, size, mtime and the
+    thumbnail size. Every lookup touches the file's mtime, and eviction
+    removes the least recently used files first.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES, size=THUMBNAIL_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = size
+        # Measured from the directory on the first write
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    def cache_path(self, path, st=None):
+        st = st or os.stat(path)
+        key = f"{os.path.abspath(path)}\0{st.st_size}\0{st.st_mtime_ns}\0{self.size}"
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest() + '.png')
+
+    def get(self, path):
+        """Return the thumbnail file of path, or None if it is not cached"""
+        try:
+            thumbnail = self.cache_path(path)
+            # Doubles as the existence check
+            os.utime(thumbnail)
+        except OSError:
+            instrumentation.count('thumbnail_miss')
+            return None
+        instrumentation.count('thumbnail_hit')
+        return thumbnail
+
+    def build(self, path):
+        """Generate and store the thumbnail of path, return its file"""
+        st = os.stat(path)
+        thumbnail = self.cache_path(path, st)
+        with instrumentation.stage('thumbnail', path=path):
+            image = make_thumbnail(path, self.size)
+        os.makedirs(self.directory, exist_ok=True)
+        with atomic_write(thumbnail) as f:
+            image.save(f, 'PNG')
+        self._added(os.path.getsize(thumbnail))
+        return thumbnail
+
+    def clear(self):
+        with self.lock:
+            for entry in self._entries():
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            self.total_bytes = 0
+
+    def _entries(self):
+        try:
+            with os.scandir(self.directory) as entries:
+                return [entry for entry in entries if entry.name.endswith('.png') and entry.is_file()]
+        except OSError:
+            return []
+
+    def _added(self, nbytes):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self.total_bytes += nbytes
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in self._entries():
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime_ns, st.st_size, entry.path))
+        files.sort()
+        total = sum(size for mtime_ns, size, path in files)
+        for mtime_ns, size, path in files:
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.total_bytes = total
+
+
+class ThumbnailLoader:
+    """Generates thumbnails on worker threads for the rows a UI shows
+
+    request() names the files currently on screen, returns the thumbnails
+    already cached and queues the rest; work queued for files that scrolled
+    out of view is cancelled. Finished thumbnails come back through poll(),
+    which the UI thread calls periodically.
+    """
+
+    def __init__(self, cache=None, workers=DEFAULT_WORKERS):
+        self.cache = cache if cache is not None else ThumbnailCache()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self.results = queue.Queue()
+        # path -> future, only touched by the UI thread
+        self.pending = {}
+
+    def request(self, paths):
+        """Return {path: thumbnail file} for the cached ones, queue the rest"""
+        wanted = set(paths)
+        for path, future in list(self.pending.items()):
+            if path not in wanted and future.cancel():
+                del self.pending[path]
+        ready = {}
+        for path in paths:
+            if path in self.pending:
+                continue
+            thumbnail = self.cache.get(path)
+            if thumbnail:
+                ready[path] = thumbnail
+            else:
+                self.pending[path] = self.executor.submit(self._build, path)
+        return ready
+
+    def poll(self):
+        """Return a list of (path, thumbnail file, error) finished since the last call"""
+        results = []
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.pop(result[0], None)
+            results.append(result)
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _build(self, path):
+        try:
+            thumbnail, error = self.cache.build(path), None
+        except Exception as e:
+            thumbnail, error = None, str(e)
+        self.results.put((path, thumbnail, error))
@@ -0,0 +1,159 @@
+import tkinter as tk
+import tkinter.font as tkfont
+from tkinter import ttk
+
+# Fill of the selected row
+SELECT_BACKGROUND = '#cce0ff'
+# Space around a row image and between it and the text
+IMAGE_PADDING = 4
+
+
+class VirtualListbox(ttk.Frame):
+    """A list that only draws the rows on screen
+
+    Rows are drawn on a canvas from callbacks: get_text(index) gives the
+    text of a row and get_image(index), if given, a Tk image shown to the
+    left of it, or None for an empty frame while the image is not ready.
+    With images every row is image_size pixels plus padding tall, so each
+    image sits on the row it belongs to. A list of 200k paths costs about as
+    much to show and scroll as a list of 30. Mirrors the parts of the
+    Listbox API the application uses and generates <<ListboxSelect>> when
+    the user selects a row and <<ListboxView>> when the rows on screen
+    change; width is in characters and height in rows, like a Listbox.
+    """
+
+    def __init__(self, master, get_text, get_image=None, image_size=0, font=None, width=40, height=15):
+        super().__init__(master)
+        self.get_text = get_text
+        self.get_image = get_image
+        self.image_size = image_size if get_image else 0
+        self.font = tkfont.Font(font=font) if font else tkfont.nametofont('TkDefaultFont')
+        self.row_height = max(self.font.metrics('linespace') + 2, self.image_size + 2 * IMAGE_PADDING)
+        self.text_x = self.image_size + 2 * IMAGE_PADDING if get_image else IMAGE_PADDING
+        self.count = 0
+        self.top = 0
+        self.page = 1
+        self.selected = None
+
+        self.canvas = tk.Canvas(self, bg='white', highlightthickness=1, takefocus=1,
+                                width=self.text_x + width * self.font.measure('0'),
+                                height=height * self.row_height)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.canvas.bind('<Configure>', lambda event: self.refresh())
+        self.canvas.bind('<Button-1>', self._on_click)
+        self.canvas.bind('<MouseWheel>', self._on_mousewheel)
+        self.canvas.bind('<Button-4>', lambda event: self._scroll_by(-3))
+        self.canvas.bind('<Button-5>', lambda event: self._scroll_by(3))
+        self.canvas.bind('<Up>', lambda event: self._move_selection(-1))
+        self.canvas.bind('<Down>', lambda event: self._move_selection(1))
+        self.canvas.bind('<Prior>', lambda event: self._move_selection(-self.page))
+        self.canvas.bind('<Next>', lambda event: self._move_selection(self.page))
+        self.canvas.bind('<Home>', lambda event: self._move_selection(-self.count))
+        self.canvas.bind('<End>', lambda event: self._move_selection(self.count))
+
+    def set_count(self, count):
+        """Set the number of rows, e.g. after the underlying list changed"""
+        self.count = count
+        if self.selected is not None and self.selected >= count:
+            self.selected = None
+        self.top = max(0, min(self.top, count - self.page))
+        self.refresh()
+
+    def visible_range(self):
+        """Return (first, end) of the rows drawn, end exclusive"""
+        # One row more than fits so there is never a gap at the bottom
+        return self.top, min(self.count, self.top + self.page + 1)
+
+    def refresh(self):
+        """Redraw the visible rows"""
+        self.page = max(1, self.canvas.winfo_height() // self.row_height)
+        self.redraw()
+        if self.count:
+            self.scrollbar.set(self.top / self.count, min(1.0, (self.top + self.page) / self.count))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        self.event_generate('<<ListboxView>>')
+
+    def redraw(self):
+        """Draw the visible rows again, e.g. once more of their images are ready"""
+        canvas = self.canvas
+        canvas.delete('all')
+        width = max(canvas.winfo_width(), int(canvas.cget('width')))
+        size = self.image_size
+        first, end = self.visible_range()
+        for index in range(first, end):
+            y = (index - first) * self.row_height
+            middle = y + self.row_height // 2
+            if index == self.selected:
+                canvas.create_rectangle(0, y, width, y + self.row_height, fill=SELECT_BACKGROUND, outline='')
+            if self.get_image:
+                image = self.get_image(index)
+                x = IMAGE_PADDING + size // 2
+                if image is not None:
+                    canvas.create_image(x, middle, image=image)
+                else:
+                    canvas.create_rectangle(x - size // 2, middle - size // 2, x + size // 2, middle + size // 2,
+                                            outline='#cccccc')
+            canvas.create_text(self.text_x, middle, text=self.get_text(index), anchor=tk.W, font=self.font)
+
+    def yview(self, *args):
+        """Scrollbar command, accepts the same arguments as Listbox.yview"""
+        if args and args[0] == 'moveto':
+            self.top = int(float(args[1]) * self.count)
+        elif args and args[0] == 'scroll':
+            amount = int(args[1])
+            self.top += amount * self.page if args[2] == 'pages' else amount
+        self.top = max(0, min(self.top, self.count - self.page))
+        self.refresh()
+
+    def curselection(self):
+        return () if self.selected is None else (self.selected,)
+
+    def selection_set(self, index):
+        self.selected = index
+        self.refresh()
+
+    def selection_clear(self, *args):
+        self.selected = None
+        self.redraw()
+
+    def see(self, index):
+        """Scroll so the row at index is visible"""
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + self.page:
+            self.top = index - self.page + 1
+        self.top = max(0, min(self.top, self.count - self.page))
+        self.refresh()
+
+    def _scroll_by(self, rows):
+        self.top = max(0, min(self.top + rows, self.count - self.page))
+        self.refresh()
+        return 'break'
+
+    def _on_mousewheel(self, event):
+        # Windows reports multiples of 120, macOS small deltas
+        step = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        return self._scroll_by(-3 * step)
+
+    def _move_selection(self, rows):
+        if not self.count:
+            return 'break'
+        current = self.top if self.selected is None else self.selected
+        self.select(max(0, min(self.count - 1, current + rows)))
+        return 'break'
+
+    def select(self, index):
+        """Select the row at index as if the user clicked it"""
+        self.selected = index
+        self.see(index)
+        self.event_generate('<<ListboxSelect>>')
+
+    def _on_click(self, event):
+        self.canvas.focus_set()
+        index = self.top + int(self.canvas.canvasy(event.y)) // self.row_height
+        if index < self.count:
+            self.select(index)